@@ -0,0 +1,408 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the HiChess project.
+# Copyright (C) 2019-2020 Haik Sargsian <haiksargsian6@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+""" Micro-benchmarks of the hot paths. Run ``python src/benchmark.py --help``. """
+
+import chess
+import chess.polyglot
+
+import argparse
+import asyncio
+import math
+import random
+import threading
+import time
+from functools import partial
+from typing import Callable, List, Sequence, Tuple
+
+import client
+import latency
+import protocol
+
+
+PACKET_SAMPLES = [(client.MOVE, "e4"),
+                  (client.MOVE, "Nbd7"),
+                  (client.MOVE, "exd8=Q+"),
+                  (client.MESSAGE, "gg"),
+                  (client.MESSAGE, "Nice game, that knight sacrifice was unexpected!"),
+                  (client.PLAYER_DATA, "player_0042")]
+
+
+def percentile(values: Sequence[float], p: float) -> float:
+    """ Nearest-rank percentile of `values`, `p` is in the range [0, 100]. """
+    if not values:
+        return math.nan
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def _rate(function: Callable[[], object], count: int) -> float:
+    startTime = time.perf_counter()
+    for _ in range(count):
+        function()
+    return count / (time.perf_counter() - startTime)
+
+
+def _report(rows: List[Tuple[str, ...]], header: Tuple[str, ...]):
+    widths = [max(len(row[i]) for row in rows + [header]) for i in range(len(header))]
+    for row in [header] + rows:
+        print("  ".join(cell.rjust(width) for cell, width in zip(row, widths)))
+
+
+def benchmarkPacket(count: int):
+    packets = [client.Packet(contentType, payload) for contentType, payload in PACKET_SAMPLES]
+
+    legacyFrames = [packet.serialize() for packet in packets]
+    compactFrames = [packet.encode() for packet in packets]
+
+    def legacyEncode():
+        for packet in packets:
+            packet.serialize()
+
+    def legacyDecode():
+        for frame in legacyFrames:
+            client.Packet.deserialize(frame).payload
+
+    def compactEncode():
+        for packet in packets:
+            packet.encode()
+
+    def compactDecode():
+        for frame in compactFrames:
+            client.Packet.decode(frame).payload
+
+    n = len(packets)
+    rows = [("legacy", f"{sum(frame.size() for frame in legacyFrames) / n:.1f}",
+             f"{_rate(legacyEncode, count) * n:,.0f}", f"{_rate(legacyDecode, count) * n:,.0f}"),
+            ("compact", f"{sum(len(frame) for frame in compactFrames) / n:.1f}",
+             f"{_rate(compactEncode, count) * n:,.0f}", f"{_rate(compactDecode, count) * n:,.0f}")]
+    _report(rows, ("format", "bytes/packet", "encoded/s", "decoded/s"))
+
+
+def benchmarkDispatch(count: int):
+    """ `Client.processBinaryMessage` on a mix of frames. Moves and chat messages are handled, one
+    handler reading the payload and the other not, server messages have no handler at all. """
+    from PySide2.QtCore import QCoreApplication, QByteArray
+    app = QCoreApplication.instance() or QCoreApplication([])
+
+    webClient = client.Client("benchmark")
+    webClient.registerHandler(client.PACKED_MOVE, lambda packet: packet.raw())
+    webClient.registerHandler(client.MESSAGE, lambda packet: packet.payload)
+    webClient.registerHandler(client.SERVER_MESSAGE, None)
+
+    frames = [QByteArray(protocol.encode(client.PACKED_MOVE, protocol.encodeMove(12, 28, 0, i, 0)))
+              for i in range(8)]
+    frames += [QByteArray(protocol.encode(client.MESSAGE, "Nice game, that knight sacrifice was unexpected!")),
+               QByteArray(protocol.encode(client.SERVER_MESSAGE, "player_0042 is back"))]
+
+    def dispatch():
+        for frame in frames:
+            webClient.processBinaryMessage(frame)
+
+    rate = _rate(dispatch, count) * len(frames)
+    _report([("dispatch", f"{rate:,.0f}", f"{1e6 / rate:.2f}")], ("path", "frames/s", "us/frame"))
+    print(webClient.counters())
+
+
+def benchmarkMove(count: int):
+    """ Decoding a received move: `parse_san` against a `PACKED_MOVE` and one legality check. """
+    rng = random.Random(0)
+    board = chess.Board()
+    samples = []
+    while len(samples) < 80 and not board.is_game_over():
+        move = rng.choice(list(board.legal_moves))
+        position = board.copy(stack=False)
+        san = board.san(move)
+        board.push(move)
+        payload = protocol.encodeMove(move.from_square, move.to_square, move.promotion or 0, len(samples),
+                                      chess.polyglot.zobrist_hash(board))
+        samples.append((position, san, payload))
+
+    def parseSan():
+        for position, san, _ in samples:
+            position.parse_san(san)
+
+    def decodePacked():
+        for position, _, payload in samples:
+            fromSquare, toSquare, promotion, ply, positionHash = protocol.decodeMove(payload)
+            position.is_legal(chess.Move(fromSquare, toSquare, promotion or None))
+
+    count = max(1, count // 100)
+    n = len(samples)
+    rows = []
+    for name, function, size in (("san", parseSan, sum(len(san.encode()) for _, san, _ in samples) / n),
+                                 ("packed", decodePacked, sum(len(payload) for _, _, payload in samples) / n)):
+        rows.append((name, f"{size:.1f}", f"{1e6 / (_rate(function, count) * n):.2f}"))
+    _report(rows, ("format", "bytes/move", "us/move"))
+
+
+def benchmarkHash(count: int):
+    """ The cost of the desync check: hashing the position after every move, next to sending the FEN. """
+    rng = random.Random(0)
+    board = chess.Board()
+    positions = []
+    while len(positions) < 80 and not board.is_game_over():
+        board.push(rng.choice(list(board.legal_moves)))
+        positions.append(board.copy(stack=False))
+
+    def zobrist():
+        for position in positions:
+            chess.polyglot.zobrist_hash(position)
+
+    def fen():
+        for position in positions:
+            position.fen()
+
+    count = max(1, count // 100)
+    n = len(positions)
+    rows = [("zobrist", "8.0", f"{1e6 / (_rate(zobrist, count) * n):.2f}"),
+            ("fen", f"{sum(len(position.fen()) for position in positions) / n:.1f}",
+             f"{1e6 / (_rate(fen, count) * n):.2f}")]
+    _report(rows, ("check", "bytes/move", "us/move"))
+
+
+def _streamMoves(moves: int, interval: float, sentAt: List[float], ready: threading.Event, port: List[int]):
+    """ Serves a single connection that gets `moves` moves, one every `interval` s, as soon as it has
+    negotiated the compact protocol. """
+    import websockets
+
+    async def handler(websocket):
+        await websocket.recv()
+        await websocket.send(protocol.encode(client.PROTOCOL, str(client.COMPACT_VERSION)))
+        for ply in range(moves):
+            sentAt[ply] = time.perf_counter()
+            await websocket.send(protocol.encode(client.PACKED_MOVE, protocol.encodeMove(12, 28, 0, ply, 0)))
+            await asyncio.sleep(interval)
+        await websocket.wait_closed()
+
+    async def serve():
+        async with websockets.serve(handler, "127.0.0.1", 0) as server:
+            port.append(server.sockets[0].getsockname()[1])
+            ready.set()
+            await asyncio.Future()
+
+    asyncio.run(serve())
+
+
+def benchmarkLatency(count: int, stall: float = 0.04, stallEvery: float = 0.1):
+    """ Moves streamed over loopback to a client on the GUI thread and to one on a network thread,
+    while the GUI thread stalls for `stall` s every `stallEvery` s, as during a heavy repaint.
+    Shows the time from the server's send and from reading the frame off the socket to the moment
+    the GUI thread handled the move. """
+    from PySide2.QtCore import QCoreApplication, QThread, QTimer
+    app = QCoreApplication.instance() or QCoreApplication([])
+
+    moves = max(1, count // 100)
+    for threaded in (False, True):
+        sentAt = [0.0] * moves
+        ready = threading.Event()
+        port: List[int] = []
+        threading.Thread(target=_streamMoves, args=(moves, 0.01, sentAt, ready, port), daemon=True).start()
+        ready.wait()
+
+        fromSend = latency.LatencyHistogram("send to screen")
+        fromRead = latency.LatencyHistogram("read to screen")
+
+        def record(ply: int, receivedAt: float):
+            now = time.perf_counter()
+            fromSend.record(now - sentAt[ply])
+            fromRead.record(now - receivedAt)
+            if fromSend.count == moves:
+                app.quit()
+
+        webClient = client.Client("")
+        webClient.moveReceived.connect(lambda move, ply, positionHash, receivedAt:
+                                       QTimer.singleShot(0, lambda: record(ply, receivedAt)))
+        networkThread = QThread()
+        if threaded:
+            webClient.moveToThread(networkThread)
+            networkThread.start()
+
+        stallTimer = QTimer()
+        stallTimer.timeout.connect(lambda: time.sleep(stall))
+        stallTimer.start(int(stallEvery * 1000))
+
+        webClient.startConnectionWithServer(f"ws://127.0.0.1:{port[0]}")
+        app.exec_()
+        stallTimer.stop()
+        webClient.close()
+        networkThread.quit()
+        networkThread.wait()
+
+        print("network thread" if threaded else "GUI thread")
+        for histogram in (fromSend, fromRead):
+            print(f"  {histogram.summary()}")
+        for line in fromSend.lines():
+            print(f"  {line}")
+
+
+def _receiveFrames(arrivals: List[Tuple[int, float]], ready: threading.Event, port: List[int]):
+    """ Serves a single connection and records the content type and the arrival time of every frame
+    it reads once the compact protocol is negotiated. """
+    import websockets
+
+    async def handler(websocket):
+        await websocket.recv()
+        await websocket.send(protocol.encode(client.PROTOCOL, str(client.COMPACT_VERSION)))
+        async for frame in websocket:
+            arrivals.append((protocol.peekContentType(frame), time.perf_counter()))
+
+    async def serve():
+        async with websockets.serve(handler, "127.0.0.1", 0, max_size=None) as server:
+            port.append(server.sockets[0].getsockname()[1])
+            ready.set()
+            await asyncio.Future()
+
+    asyncio.run(serve())
+
+
+def benchmarkQueue(count: int):
+    """ A chat paste of ``count / 50`` full messages with a move right behind it, sent without the
+    pacing of the chat and with and without the watermarks of the send queue. Shows how long the move
+    took to reach the server and the counters of the queue. """
+    from PySide2.QtCore import QCoreApplication, QTimer
+    import ratelimit
+    app = QCoreApplication.instance() or QCoreApplication([])
+
+    paste = max(1, count // 50)
+    rows = []
+    for name, highWatermark in (("none", 2 ** 62), ("watermarks", client.HIGH_WATERMARK)):
+        arrivals: List[Tuple[int, float]] = []
+        ready = threading.Event()
+        port: List[int] = []
+        threading.Thread(target=_receiveFrames, args=(arrivals, ready, port), daemon=True).start()
+        ready.wait()
+
+        webClient = client.Client("")
+        webClient.chatBucket = ratelimit.TokenBucket(math.inf, paste)
+        webClient.sendQueue = client.SendQueue(highWatermark, min(highWatermark, client.LOW_WATERMARK))
+        sentAt = [0.0]
+
+        def sendBurst():
+            for _ in range(paste):
+                webClient.sendPacket(client.MESSAGE, "x" * protocol.MAX_MESSAGE_LENGTH)
+            sentAt[0] = time.perf_counter()
+            webClient.sendPacket(client.PACKED_MOVE, protocol.encodeMove(12, 28, 0, 0, 0))
+
+        def check():
+            if len(arrivals) == paste + 1:
+                app.quit()
+
+        webClient.negotiated.connect(sendBurst)
+        ticker = QTimer()
+        ticker.timeout.connect(check)
+        ticker.start(1)
+        webClient.startConnectionWithServer(f"ws://127.0.0.1:{port[0]}")
+        app.exec_()
+        ticker.stop()
+
+        moveArrival = next(arrivedAt for contentType, arrivedAt in arrivals if contentType == client.PACKED_MOVE)
+        chat = webClient.sendQueue.metrics()["chat"]
+        rows.append((name, f"{(moveArrival - sentAt[0]) * 1000:.1f}", f"{chat['sent']}", f"{chat['dropped']}",
+                     f"{webClient.sendQueue.congestions}", f"{chat['maxDelay']:.1f}"))
+        webClient.close()
+    _report(rows, ("watermarks", "move wait ms", "chat sent", "chat dropped", "held back", "chat max delay ms"))
+
+
+def benchmarkChat(count: int):
+    """ A burst of chat messages, ``count / 20`` of them, emitted by another thread as after a
+    reconnection and laid out on the GUI thread and on the layout thread of the chat. Shows the
+    longest the GUI thread went without running a 1 ms timer and when the last message was in the view.
+    """
+    from PySide2.QtWidgets import QApplication
+    from PySide2.QtCore import QObject, QTimer, Signal
+    import chatwidget
+    app = QApplication.instance() or QApplication([])
+
+    class Sender(QObject):
+        messageReceived = Signal(str)
+
+    rng = random.Random(0)
+    words = [sample for _, sample in PACKET_SAMPLES if " " in sample][0].split()
+    burst = max(1, count // 20)
+    messages = [" ".join(rng.choice(words) for _ in range(rng.randint(1, 60))) for _ in range(burst)]
+
+    rows = []
+    for threaded in (False, True):
+        chat = chatwidget.ChatWidget(historySize=burst, layoutThread=threaded)
+        chat.resize(350, 700)
+        chat.show()
+
+        gaps = latency.LatencyHistogram("event loop gaps")
+        lastTick = [time.perf_counter()]
+
+        def tick():
+            now = time.perf_counter()
+            gaps.record(now - lastTick[0])
+            lastTick[0] = now
+
+        # like `client.Client.messageReceived`, emitted on another thread and queued to the GUI thread
+        sender = Sender()
+        sender.messageReceived.connect(partial(chat.showMessage, chatwidget.OPPONENT))
+        startTime = [0.0]
+        shownAfter = [0.0]
+
+        def emitMessages():
+            for message in messages:
+                sender.messageReceived.emit(message)
+
+        def deliver():
+            startTime[0] = time.perf_counter()
+            threading.Thread(target=emitMessages, daemon=True).start()
+
+        def check():
+            if not shownAfter[0] and chat.model.rowCount() == burst:
+                shownAfter[0] = time.perf_counter() - startTime[0]
+                QTimer.singleShot(200, app.quit)
+
+        ticker = QTimer()
+        ticker.timeout.connect(tick)
+        ticker.timeout.connect(check)
+        ticker.start(1)
+        QTimer.singleShot(200, deliver)
+        app.exec_()
+        ticker.stop()
+
+        chat.stopLayoutThread()
+        chat.close()
+        rows.append(("layout thread" if threaded else "GUI thread", f"{gaps.maximum:.1f}",
+                     f"{gaps.percentile(99):.1f}", f"{shownAfter[0] * 1000:.1f}"))
+    _report(rows, ("chat layout", "longest stall ms", "p99 gap ms", "all shown after ms"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="HiChess micro-benchmarks")
+    parser.add_argument("benchmark", choices=["packet", "move", "hash", "dispatch", "latency", "queue",
+                                                     "chat"])
+    parser.add_argument("-n", "--count", type=int, default=20000, help="number of iterations")
+    args = parser.parse_args()
+
+    if args.benchmark == "packet":
+        benchmarkPacket(args.count)
+    elif args.benchmark == "move":
+        benchmarkMove(args.count)
+    elif args.benchmark == "hash":
+        benchmarkHash(args.count)
+    elif args.benchmark == "dispatch":
+        benchmarkDispatch(args.count)
+    elif args.benchmark == "latency":
+        benchmarkLatency(args.count)
+    elif args.benchmark == "queue":
+        benchmarkQueue(args.count)
+    elif args.benchmark == "chat":
+        benchmarkChat(args.count)
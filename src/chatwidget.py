@@ -17,13 +17,18 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import PySide2.QtWidgets as QtWidgets
-from PySide2.QtCore import Qt, Signal, Slot
-from PySide2.QtGui import QTextOption, QFontMetrics, QIcon
+from PySide2.QtCore import Qt, Signal, Slot, QEvent, QObject, QThread, QTimer, QAbstractListModel, QModelIndex, \
+    QPointF, QRect, QRectF, QSize
+from PySide2.QtGui import QTextOption, QTextLayout, QFont, QFontMetrics, QIcon, QKeySequence, QPainter, \
+    QPalette
 from enum import Enum
+import math
 import time
+from typing import List, Optional, Tuple
 
 import resources
 import textwrap
+import protocol
 
 
 class Sender(Enum):
@@ -36,29 +41,261 @@ YOU = Sender.YOU
 OPPONENT = Sender.OPPONENT
 SERVER = Sender.SERVER
 
+# messages kept in the chat by default, the oldest ones are dropped beyond it
+HISTORY_SIZE = 500
+
+# roles of `ChatModel` besides Qt.DisplayRole, which is the text of the message
+SENDER_ROLE = Qt.UserRole
+TIME_ROLE = Qt.UserRole + 1
+
+# pixels between the text and the border of a bubble, around a bubble and its corner radius
+BUBBLE_PADDING = 5
+BUBBLE_MARGIN = 4
+BUBBLE_RADIUS = 8
+
+_textOption = QTextOption()
+_textOption.setWrapMode(QTextOption.WrapAtWordBoundaryOrAnywhere)
+_headerOption = QTextOption(Qt.AlignCenter)
+# what the line breaks of a message are turned into for `QTextLayout`
+LINE_SEPARATOR = "\u2028"
+# ms between two layouts of the chat while the dock is being resized
+RELAYOUT_INTERVAL = 16
+
+
+class TextLayout:
+    """ The lines of a message: the offset, length and baseline of each of them, with the width
+    the text was laid out in, whether it had to be wrapped to fit in it, the width of its widest
+    line and its height. """
+    __slots__ = ("width", "wrapped", "idealWidth", "height", "lines")
+
+    def __init__(self, width: int, wrapped: bool, idealWidth: int, height: int, lines: List[Tuple[int, int, float]]):
+        self.width = width
+        self.wrapped = wrapped
+        self.idealWidth = idealWidth
+        self.height = height
+        self.lines = lines
+
+    def fits(self, width: int) -> bool:
+        """ Tells whether the layout is still the one of the text in `width` pixels: a text that
+        didn't have to be wrapped keeps its lines as long as the widest one fits. """
+        return width == self.width or (not self.wrapped and self.idealWidth <= width)
+
+
+def layoutText(text: str, font: QFont, width: int) -> TextLayout:
+    """ Wraps `text` to `width` pixels at word boundaries, or anywhere in a word that doesn't fit. """
+    text = text.replace("\n", LINE_SEPARATOR)
+    layout = QTextLayout(text, font)
+    layout.setTextOption(_textOption)
+    layout.beginLayout()
+    lines = []
+    y = 0.0
+    naturalWidth = 0.0
+    while True:
+        line = layout.createLine()
+        if not line.isValid():
+            break
+        line.setLineWidth(width)
+        line.setPosition(QPointF(0, y))
+        lines.append((line.textStart(), line.textLength(), y + line.ascent()))
+        y += line.height()
+        naturalWidth = max(naturalWidth, line.naturalTextWidth())
+    layout.endLayout()
+
+    # without wrapping there is a line for each paragraph
+    wrapped = len(lines) > text.count(LINE_SEPARATOR) + 1
+    return TextLayout(width, wrapped, math.ceil(naturalWidth), math.ceil(y), lines)
+
+
+class ChatMessage:
+    __slots__ = ("sender", "timestamp", "text", "header", "layout", "layoutGeneration")
+
+    def __init__(self, sender: Sender, timestamp: float, text: str, header: str = ""):
+        self.sender = sender
+        self.timestamp = timestamp
+        self.text = text
+        # the time shown above the message when the minute changed since the previous one
+        self.header = header
+        # the wrapped text and the font it was laid out with, see `MessageDelegate.textLayout`
+        self.layout: Optional[TextLayout] = None
+        self.layoutGeneration = -1
+
+
+def layoutMessages(entries: List[Tuple[Sender, float, str]], font: QFont, width: int,
+                   fontGeneration: int) -> List[ChatMessage]:
+    """ Makes the messages of `entries`, each one the sender, the time and the text of a message,
+    and lays them out for `width`, which only needs fonts and can be done on any thread. """
+    messages = []
+    for sender, timestamp, text in entries:
+        message = ChatMessage(sender, timestamp, text)
+        message.layout = layoutText(text, font, width)
+        message.layoutGeneration = fontGeneration
+        messages.append(message)
+    return messages
+
+
+class LayoutWorker(QObject):
+    """ Lays the messages of a `ChatWidget` out on the thread it was moved to. """
+    laidOut = Signal(object)
+
+    @Slot(object)
+    def layout(self, request: Tuple[int, List[Tuple[Sender, float, str]], QFont, int, int]):
+        batch, entries, font, width, fontGeneration = request
+        self.laidOut.emit((batch, layoutMessages(entries, font, width, fontGeneration)))
+
+
+class ChatModel(QAbstractListModel):
+    """ The messages of the chat, oldest first, in a ring buffer of `historySize` messages. """
+    def __init__(self, historySize: int = HISTORY_SIZE, parent=None):
+        super(ChatModel, self).__init__(parent)
+
+        self.historySize = max(1, historySize)
+        self._messages: List[Optional[ChatMessage]] = [None] * self.historySize
+        self._start = 0
+        self._count = 0
+        self._lastTime = ""
+
+    def rowCount(self, parent=QModelIndex()) -> int:
+        return 0 if parent.isValid() else self._count
+
+    def message(self, row: int) -> ChatMessage:
+        return self._messages[(self._start + row) % self.historySize]
+
+    def messages(self) -> List[ChatMessage]:
+        return [self.message(row) for row in range(self._count)]
+
+    def data(self, index: QModelIndex, role: int = Qt.DisplayRole):
+        if not index.isValid() or not 0 <= index.row() < self._count:
+            return None
+
+        message = self.message(index.row())
+        if role == Qt.DisplayRole:
+            return message.text
+        if role == SENDER_ROLE:
+            return message.sender.value
+        if role == TIME_ROLE:
+            return message.timestamp
+        return None
+
+    def append(self, sender: Sender, text: str, timestamp: Optional[float] = None) -> ChatMessage:
+        message = ChatMessage(sender, time.time() if timestamp is None else timestamp, text)
+        self.extend([message])
+        return message
+
+    def extend(self, messages: List[ChatMessage]):
+        """ Adds `messages` with a single insertion, dropping as many of the oldest ones as needed. """
+        messages = messages[-self.historySize:]
+        if not messages:
+            return
+
+        for message in messages:
+            header = time.strftime("%I:%M %p", time.localtime(message.timestamp))
+            message.header = "" if header == self._lastTime else header
+            self._lastTime = header
+
+        dropped = self._count + len(messages) - self.historySize
+        if dropped > 0:
+            self.beginRemoveRows(QModelIndex(), 0, dropped - 1)
+            for _ in range(dropped):
+                self._messages[self._start] = None
+                self._start = (self._start + 1) % self.historySize
+            self._count -= dropped
+            self.endRemoveRows()
+
+        self.beginInsertRows(QModelIndex(), self._count, self._count + len(messages) - 1)
+        for message in messages:
+            self._messages[(self._start + self._count) % self.historySize] = message
+            self._count += 1
+        self.endInsertRows()
+
+    def clear(self):
+        self.beginResetModel()
+        self._messages = [None] * self.historySize
+        self._start = 0
+        self._count = 0
+        self._lastTime = ""
+        self.endResetModel()
+
+
+class MessageDelegate(QtWidgets.QStyledItemDelegate):
+    """ Paints the messages of a `ChatModel` as bubbles, yours on the left, your opponent's on the
+    right and the server's in the middle. The layout of a message is kept until the font or the
+    width it depends on changes, see `textLayout`, and painting only draws its lines.
+    """
+    def __init__(self, view: QtWidgets.QListView):
+        super(MessageDelegate, self).__init__(view)
+
+        self.view = view
+        self.fontGeneration = 0
+        self._setFont(view.font())
+        view.installEventFilter(self)
+
+    def _setFont(self, font: QFont):
+        self.font = font
+        self._headerHeight = QFontMetrics(font).height() + BUBBLE_MARGIN
+
+    def eventFilter(self, watched, event: QEvent) -> bool:
+        if watched is self.view and event.type() == QEvent.FontChange:
+            self._setFont(self.view.font())
+            self.fontGeneration += 1
+            self.view.scheduleDelayedItemsLayout()
+        return False
+
+    def textWidth(self) -> int:
+        """ The widest the text of a bubble can be in the current width of the view. """
+        return max(1, self.view.viewport().width() - 2 * (BUBBLE_MARGIN + BUBBLE_PADDING))
+
+    def textLayout(self, message: ChatMessage) -> TextLayout:
+        """ The layout of `message` for the current width of the view, see `TextLayout.fits`. """
+        width = self.textWidth()
+        if message.layoutGeneration != self.fontGeneration or not message.layout.fits(width):
+            message.layout = layoutText(message.text, self.font, width)
+            message.layoutGeneration = self.fontGeneration
+        return message.layout
+
+    def sizeHint(self, option: QtWidgets.QStyleOptionViewItem, index: QModelIndex) -> QSize:
+        message = index.model().message(index.row())
+        layout = self.textLayout(message)
+        headerHeight = self._headerHeight if message.header else 0
+        return QSize(self.view.viewport().width(), headerHeight + layout.height + 2 * (BUBBLE_PADDING + BUBBLE_MARGIN))
+
+    def paint(self, painter: QPainter, option: QtWidgets.QStyleOptionViewItem, index: QModelIndex):
+        message = index.model().message(index.row())
+        layout = self.textLayout(message)
+        rect = option.rect
+        palette = option.palette
+
+        painter.save()
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.setFont(self.font)
+
+        top = rect.top() + BUBBLE_MARGIN
+        if message.header:
+            painter.setPen(palette.color(QPalette.PlaceholderText))
+            painter.drawText(QRectF(rect.left(), top, rect.width(), self._headerHeight - BUBBLE_MARGIN),
+                             message.header, _headerOption)
+            top += self._headerHeight
+
+        bubbleWidth = layout.idealWidth + 2 * BUBBLE_PADDING
+        if message.sender == YOU:
+            left = rect.left() + BUBBLE_MARGIN
+        elif message.sender == OPPONENT:
+            left = rect.right() - BUBBLE_MARGIN - bubbleWidth
+        else:
+            left = rect.left() + (rect.width() - bubbleWidth) // 2
+        bubble = QRect(left, top, bubbleWidth, layout.height + 2 * BUBBLE_PADDING)
 
-class MessageWidget(QtWidgets.QTextBrowser):
-    def __init__(self, message: str, parent=None):
-        super(MessageWidget, self).__init__(parent)
+        selected = self.view.selectionModel().isSelected(index)
+        painter.setPen(palette.color(QPalette.Mid))
+        painter.setBrush(palette.color(QPalette.Highlight if selected else QPalette.Base))
+        painter.drawRoundedRect(bubble, BUBBLE_RADIUS, BUBBLE_RADIUS)
 
-        self.document().documentLayout().documentSizeChanged.connect(self.sizeChanged)
-        self.setWordWrapMode(QTextOption.WrapAtWordBoundaryOrAnywhere)
-        self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
-        self.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
-        self.setPlainText(message)
-
-    @Slot()
-    def sizeChanged(self, newSize):
-        fm = QFontMetrics(self.font())
-        self.setMaximumWidth(max(min([fm.horizontalAdvance(self.toPlainText())+10, newSize.toSize().width()+10]), 40))
-        if self.width() < self.document().textWidth():
-            self.document().setTextWidth(self.width())
-        self.setFixedHeight(newSize.height()+2)
-
-    def focusOutEvent(self, event):
-        cursor = self.textCursor()
-        cursor.clearSelection()
-        self.setTextCursor(cursor)
+        painter.setPen(palette.color(QPalette.HighlightedText if selected else QPalette.Text))
+        x = bubble.left() + BUBBLE_PADDING
+        y = bubble.top() + BUBBLE_PADDING
+        text = message.text
+        for start, length, baseline in layout.lines:
+            painter.drawText(QPointF(x, y + baseline), text[start:start + length].rstrip("\n"))
+        painter.restore()
 
 
 class MessageInputWidget(QtWidgets.QTextEdit):
@@ -81,26 +318,76 @@ class MessageInputWidget(QtWidgets.QTextEdit):
 
 
 class ChatWidget(QtWidgets.QDockWidget):
+    """ The chat of a game. The messages shown in the same pass of the event loop are laid out
+    together on a thread of their own unless `layoutThread` is false, and the GUI thread only
+    inserts them into the view, so that a burst of messages doesn't hold up the board. """
     messageToBeSent = Signal(str)
+    _layoutRequested = Signal(object)
 
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, historySize: int = HISTORY_SIZE, layoutThread: bool = True):
         super(ChatWidget, self).__init__(parent=parent, flags=Qt.Window)
 
-        self.time = ""
         self.setMinimumWidth(300)
 
         self.container = QtWidgets.QWidget()
 
         self.mainLayout = QtWidgets.QVBoxLayout()
 
-        self.scrollArea = QtWidgets.QScrollArea()
-        self.scrollArea.setWidgetResizable(True)
-        self.scrollArea.setVerticalScrollBarPolicy(Qt.ScrollBarAsNeeded)
-
-        self.chat = QtWidgets.QWidget()
-        self.scrollArea.setFocusPolicy(Qt.NoFocus)
-        self.chatLayout = QtWidgets.QVBoxLayout()
-        self.chatLayout.setAlignment(Qt.AlignTop)
+        # only the visible rows are laid out and painted, the others are sized in batches
+        self.model = ChatModel(historySize, self)
+        self.view = QtWidgets.QListView()
+        self.view.setModel(self.model)
+        self.view.setItemDelegate(MessageDelegate(self.view))
+        self.view.setVerticalScrollMode(QtWidgets.QAbstractItemView.ScrollPerPixel)
+        self.view.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        # the scroll bar showing up would change the width every message was laid out for
+        self.view.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOn)
+        # resizes are laid out by `_relayoutTimer` rather than on every resize event
+        self.view.setResizeMode(QtWidgets.QListView.Fixed)
+        self.view.setLayoutMode(QtWidgets.QListView.Batched)
+        self.view.setBatchSize(200)
+        self.view.setSelectionMode(QtWidgets.QAbstractItemView.ExtendedSelection)
+        self.view.setFocusPolicy(Qt.ClickFocus)
+        self._relayoutTimer = QTimer(self)
+        self._relayoutTimer.setSingleShot(True)
+        self._relayoutTimer.setInterval(RELAYOUT_INTERVAL)
+        self._relayoutTimer.timeout.connect(self.relayout)
+        self._laidOutWidth = 0
+        self.view.viewport().installEventFilter(self)
+        # the view follows the conversation unless the user scrolled up to read older messages,
+        # the range grows as the messages are laid out in batches
+        self._following = True
+        self.view.verticalScrollBar().valueChanged.connect(self.onScrolled)
+        self.view.verticalScrollBar().rangeChanged.connect(self.onRangeChanged)
+
+        # the messages waiting to be laid out and the batch they belong to, which `clear` makes stale
+        self._pending: List[Tuple[Sender, float, str]] = []
+        self._batch = 0
+        self._flushTimer = QTimer(self)
+        self._flushTimer.setSingleShot(True)
+        self._flushTimer.setInterval(0)
+        self._flushTimer.timeout.connect(self.flushMessages)
+
+        self.layoutThread: Optional[QThread] = None
+        if layoutThread:
+            self.layoutThread = QThread(self)
+            self._layoutWorker = LayoutWorker()
+            self._layoutWorker.moveToThread(self.layoutThread)
+            self.layoutThread.finished.connect(self._layoutWorker.deleteLater)
+            self._layoutRequested.connect(self._layoutWorker.layout)
+            self._layoutWorker.laidOut.connect(self.onMessagesLaidOut)
+            self.layoutThread.start()
+            # a chat deleted or still alive at exit without `stopLayoutThread` would otherwise
+            # destroy its thread running
+            thread = self.layoutThread
+            self.destroyed.connect(lambda: (thread.quit(), thread.wait()))
+            QtWidgets.QApplication.instance().aboutToQuit.connect(self.stopLayoutThread)
+
+        copyAction = QtWidgets.QAction(self.view)
+        copyAction.setShortcut(QKeySequence.Copy)
+        copyAction.setShortcutContext(Qt.WidgetWithChildrenShortcut)
+        copyAction.triggered.connect(self.copySelection)
+        self.addAction(copyAction)
 
         self.messageInputWidget = MessageInputWidget()
         self.messageInputWidget.setPlaceholderText("Type a message here...")
@@ -120,33 +407,25 @@ class ChatWidget(QtWidgets.QDockWidget):
         self.messageInputLayout.setContentsMargins(0, 0, 0, 0)
         self.messageInputLayout.setSpacing(0)
 
-        self.mainLayout.addWidget(self.scrollArea)
+        self.mainLayout.addWidget(self.view)
         self.mainLayout.addLayout(self.messageInputLayout)
         self.mainLayout.setAlignment(Qt.AlignCenter)
         self.mainLayout.setContentsMargins(0, 0, 0, 0)
         self.mainLayout.setSpacing(0)
 
-        self.lastMessageSender = None
-
-        self.scrollArea.verticalScrollBar().rangeChanged.connect(self.onRangeChanged)
-
-        self.chat.setLayout(self.chatLayout)
-        self.scrollArea.setWidget(self.chat)
         self.container.setLayout(self.mainLayout)
         self.setWidget(self.container)
 
         self.setFocusProxy(self.messageInputWidget)
 
-    @Slot()
-    def onRangeChanged(self, min, max):
-        if self.lastMessageSender == YOU:
-            self.lastMessageSender = None
-            self.scrollArea.verticalScrollBar().setValue(max)
+    @property
+    def historySize(self) -> int:
+        return self.model.historySize
 
     @Slot()
     def sendMessage(self):
         text = self.messageInputWidget.toPlainText()
-        wrapped = textwrap.wrap(text, 1600)
+        wrapped = textwrap.wrap(text, protocol.MAX_MESSAGE_LENGTH)
         for chunk in wrapped:
             self.showMessage(YOU, chunk)
             self.messageToBeSent.emit(chunk)
@@ -154,22 +433,75 @@ class ChatWidget(QtWidgets.QDockWidget):
         self.messageInputWidget.setFocus()
 
     def showMessage(self, sender: Sender, message: str) -> None:
-        if self.time != time.strftime("%I:%M %p"):
-            self.time = time.strftime("%I:%M %p")
-            timeLabel = QtWidgets.QLabel(self.time)
-            timeLabel.setSizePolicy(QtWidgets.QSizePolicy(
-                QtWidgets.QSizePolicy.Expanding, QtWidgets.QSizePolicy.Fixed
-            ))
-            timeLabel.setAlignment(Qt.AlignCenter)
-            self.chatLayout.addWidget(timeLabel)
+        if sender == YOU:
+            self._following = True
+        self._pending.append((sender, time.time(), message))
+        if not self._flushTimer.isActive():
+            self._flushTimer.start()
 
-        self.lastMessageSender = sender
+    @Slot()
+    def flushMessages(self):
+        """ Lays the pending messages out for the current font and width. If either changes before
+        the result is inserted, the delegate lays the messages out again. """
+        entries, self._pending = self._pending, []
+        if not entries:
+            return
+
+        delegate = self.view.itemDelegate()
+        width = delegate.textWidth()
+        if self.layoutThread is None:
+            self.model.extend(layoutMessages(entries, delegate.font, width, delegate.fontGeneration))
+        else:
+            self._layoutRequested.emit((self._batch, entries, QFont(delegate.font), width, delegate.fontGeneration))
+
+    @Slot(object)
+    def onMessagesLaidOut(self, result: Tuple[int, List[ChatMessage]]):
+        batch, messages = result
+        if batch == self._batch:
+            self.model.extend(messages)
+
+    def stopLayoutThread(self):
+        """ Waits for the layout thread to finish, the messages shown afterwards are laid out on the
+        GUI thread. """
+        if self.layoutThread is not None:
+            self._layoutRequested.disconnect(self._layoutWorker.layout)
+            self.layoutThread.quit()
+            self.layoutThread.wait()
+            self.layoutThread = None
+
+    @Slot(int)
+    def onScrolled(self, value: int):
+        self._following = value == self.view.verticalScrollBar().maximum()
+
+    @Slot(int, int)
+    def onRangeChanged(self, minimum: int, maximum: int):
+        if self._following:
+            self.view.verticalScrollBar().setValue(maximum)
+
+    def eventFilter(self, watched, event: QEvent) -> bool:
+        if watched is self.view.viewport() and event.type() == QEvent.Resize:
+            if event.size().width() != self._laidOutWidth and not self._relayoutTimer.isActive():
+                self._relayoutTimer.start()
+        return super(ChatWidget, self).eventFilter(watched, event)
 
-        messageWidget = MessageWidget(message)
+    @Slot()
+    def relayout(self):
+        """ Lays the messages out for the width of the view, once for all the resize events
+        received in the last `RELAYOUT_INTERVAL` ms. """
+        self._laidOutWidth = self.view.viewport().width()
+        self.view.doItemsLayout()
 
-        if sender == YOU:
-            self.chatLayout.addWidget(messageWidget, alignment=Qt.AlignLeft)
-        elif sender == OPPONENT:
-            self.chatLayout.addWidget(messageWidget, alignment=Qt.AlignRight)
-        else:
-            self.chatLayout.addWidget(messageWidget, alignment=Qt.AlignHCenter)
+    @Slot()
+    def copySelection(self):
+        rows = sorted(index.row() for index in self.view.selectionModel().selectedIndexes())
+        if rows:
+            QtWidgets.QApplication.clipboard().setText("\n".join(self.model.message(row).text for row in rows))
+
+    def clear(self):
+        """ Empties the chat for the next game. """
+        self._pending.clear()
+        self._flushTimer.stop()
+        self._batch += 1
+        self.model.clear()
+        self.messageInputWidget.clear()
+        self._following = True
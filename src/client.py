@@ -18,22 +18,109 @@
 
 import PySide2.QtCore as QtCore
 import PySide2.QtWebSockets as QtWebSockets
-from PySide2.QtNetwork import QAbstractSocket
+from PySide2.QtNetwork import QAbstractSocket, QNetworkInterface, QHostAddress
 
-import socket
+import chess
 
+import collections
 import logging
+import math
+import time
+from functools import partial, wraps
+from typing import Callable, Deque, Dict, List, Optional, Sequence, Union
 from numpy import uint8, int64
 
+import discovery
+import protocol
+import ratelimit
+import recorder
+from protocol import NONE, PLAYER_DATA, WHITE_PLAYER_DATA, BLACK_PLAYER_DATA, MESSAGE, SERVER_MESSAGE, MOVE, \
+    ERROR, PROTOCOL, SESSION, RESUME, RESUMED, PACKED_MOVE, RESYNC, LEAVE, WATCH, SPECTATE, SNAPSHOT, \
+    LEGACY_VERSION, COMPACT_VERSION, DEFAULT_PORT, FLAG_CHANNEL
+
 
 ContentType = uint8
-[NONE, PLAYER_DATA, WHITE_PLAYER_DATA, BLACK_PLAYER_DATA, MESSAGE, SERVER_MESSAGE, MOVE, ERROR] = range(8)
+
+# delay between two connection attempts, as recommended by RFC 8305
+CONNECTION_ATTEMPT_DELAY = 250
+# exponential backoff of the reconnection attempts in ms, see `Client.reconnect`
+RECONNECT_BASE_DELAY = 500
+RECONNECT_MAX_DELAY = 16000
+RECONNECT_ATTEMPTS = 8
+# ms between two WebSocket pings and, by default, of silence after which the connection is
+# considered dead, see `Client.heartbeat`
+HEARTBEAT_INTERVAL = 2000
+DEAD_TIMEOUT = 10000
+
+# priority lanes of the send queue, the first one is never held back, see `SendQueue`
+[CONTROL_LANE, CHAT_LANE] = range(2)
+LANE_NAMES = ["control", "chat"]
+# bytes waiting in the socket above which the lower lanes are held back and below which they resume
+HIGH_WATERMARK = 64 * 1024
+LOW_WATERMARK = 16 * 1024
+
+
+def _onClientThread(method):
+    """ Makes `method` of a `Client` run on the thread the client lives in. Called from another
+    thread, it is queued to the client's thread and returns None. """
+    @wraps(method)
+    def wrapper(self, *args):
+        if QtCore.QThread.currentThread() is self.thread():
+            return method(self, *args)
+        self._invoke.emit(partial(method, self, *args))
+    return wrapper
 
 
 class Packet:
-    def __init__(self, contentType: ContentType = NONE, payload: str = ""):
+    def __init__(self, contentType: ContentType = NONE, payload: Union[str, bytes] = "", flags: int = 0,
+                 channel: int = 0):
         self.contentType = contentType
-        self.payload = payload
+        self.flags = flags
+        self.channel = channel
+        # time.perf_counter() when the frame was read from the socket
+        self.receivedAt = 0.0
+        self._payload = payload
+        # the undecoded payload of a received packet, see `decode`
+        self._raw: Optional[memoryview] = None
+        self._encoding = "utf-8"
+
+    @property
+    def payload(self) -> Union[str, bytes]:
+        if self._raw is not None:
+            if self.contentType in protocol.BINARY_CONTENT_TYPES:
+                self._payload = bytes(self._raw)
+            else:
+                self._payload = str(self._raw, self._encoding)
+            self._raw = None
+        return self._payload
+
+    @payload.setter
+    def payload(self, payload: Union[str, bytes]):
+        self._payload = payload
+        self._raw = None
+
+    def raw(self) -> memoryview:
+        """ The payload as it is on the wire, without decoding it. """
+        if self._raw is not None:
+            return self._raw
+        if isinstance(self._payload, str):
+            return memoryview(self._payload.encode(self._encoding))
+        return memoryview(self._payload)
+
+    def encode(self) -> bytes:
+        return protocol.encode(self.contentType, self.payload, self.flags, self.channel)
+
+    @staticmethod
+    def decode(data: bytes) -> "Packet":
+        """ Decodes the header of a frame in either of the wire formats. The payload is decoded the
+        first time it is accessed. """
+        packet = Packet()
+        if protocol.frameVersion(data) == LEGACY_VERSION:
+            packet.contentType, packet._raw = protocol.decodeLegacyView(data)
+            packet._encoding = "utf-16-be"
+        else:
+            packet.contentType, packet.flags, packet.channel, packet._raw = protocol.decode(data)
+        return packet
 
     def serialize(self) -> QtCore.QByteArray:
         _bytearray = QtCore.QByteArray()
@@ -55,65 +142,877 @@ class Packet:
         return packet
 
 
+class SendQueue:
+    """ Outgoing frames ordered by priority lanes. Frames of the `CONTROL_LANE`, the moves and the
+    protocol packets, are written at once. The other lanes are written in order of priority as long
+    as less than the high watermark of bytes waits in the socket, after which they are held back
+    until the socket drains below the low watermark. So a long chat paste never delays a move by more
+    than the high watermark.
+    """
+
+    def __init__(self, highWatermark: int = HIGH_WATERMARK, lowWatermark: int = LOW_WATERMARK):
+        self.highWatermark = highWatermark
+        self.lowWatermark = lowWatermark
+        self.congested = False
+
+        self.lanes = [collections.deque() for _ in LANE_NAMES]
+        self.queuedBytes = [0] * len(LANE_NAMES)
+        # per lane: frames written, the total and the longest time they waited in the queue in s
+        self.sentFrames = [0] * len(LANE_NAMES)
+        self.totalDelay = [0.0] * len(LANE_NAMES)
+        self.maxDelay = [0.0] * len(LANE_NAMES)
+        # per lane: frames discarded by `clear` before they were written, and the times the high
+        # watermark held the queue back
+        self.droppedFrames = [0] * len(LANE_NAMES)
+        self.congestions = 0
+
+    def push(self, webSocket: QtWebSockets.QWebSocket, frame: QtCore.QByteArray, lane: int) -> int64:
+        if lane == CONTROL_LANE:
+            self.sentFrames[lane] += 1
+            return webSocket.sendBinaryMessage(frame)
+
+        self.lanes[lane].append((time.perf_counter(), frame))
+        self.queuedBytes[lane] += frame.size()
+        self.pump(webSocket)
+        return frame.size()
+
+    def pump(self, webSocket: QtWebSockets.QWebSocket):
+        pending = webSocket.bytesToWrite()
+        if self.congested:
+            if pending > self.lowWatermark:
+                return
+            self.congested = False
+
+        now = time.perf_counter()
+        for lane, queue in enumerate(self.lanes):
+            while queue:
+                if pending >= self.highWatermark:
+                    self.congested = True
+                    self.congestions += 1
+                    logging.debug(f"Send queue held back at {pending} bytes to write, "
+                                  f"{self.depth()} frames waiting")
+                    return
+
+                queuedTime, frame = queue.popleft()
+                self.queuedBytes[lane] -= frame.size()
+                webSocket.sendBinaryMessage(frame)
+                pending = webSocket.bytesToWrite()
+
+                delay = now - queuedTime
+                self.sentFrames[lane] += 1
+                self.totalDelay[lane] += delay
+                self.maxDelay[lane] = max(self.maxDelay[lane], delay)
+
+    def clear(self):
+        dropped = self.depth()
+        if dropped:
+            logging.debug(f"Send queue dropped {dropped} frames that were never written")
+        for lane, queue in enumerate(self.lanes):
+            self.droppedFrames[lane] += len(queue)
+            queue.clear()
+        self.queuedBytes = [0] * len(LANE_NAMES)
+        self.congested = False
+
+    def depth(self, lane: Optional[int] = None) -> int:
+        """ The number of frames waiting in `lane` or in all of them. """
+        if lane is None:
+            return sum(len(queue) for queue in self.lanes)
+        return len(self.lanes[lane])
+
+    def metrics(self) -> dict:
+        """ Depth, queued bytes, written and dropped frames and queueing delay in ms of each lane. """
+        return {name: {"depth": len(self.lanes[lane]),
+                       "bytes": self.queuedBytes[lane],
+                       "sent": self.sentFrames[lane],
+                       "dropped": self.droppedFrames[lane],
+                       "averageDelay": self.totalDelay[lane] / self.sentFrames[lane] * 1000
+                       if self.sentFrames[lane] else 0.0,
+                       "maxDelay": self.maxDelay[lane] * 1000}
+                for lane, name in enumerate(LANE_NAMES)}
+
+
+class GameChannel(QtCore.QObject):
+    """ A game played over a channel of a `Client`'s connection, so that one connection can take
+    part in several games at once. Channels need the compact protocol and, unlike the game of
+    channel 0, are not resumed after the connection is lost. See `Client.openChannel`.
+    """
+    gameStarted = QtCore.Signal(Packet)
+    moveReceived = QtCore.Signal(chess.Move, int, object, float)
+    resynced = QtCore.Signal(int, str)
+    left = QtCore.Signal()
+    messageReceived = QtCore.Signal(str)
+    serverMessageReceived = QtCore.Signal(str)
+    serverError = QtCore.Signal(str)
+
+    def __init__(self, client: "Client", channel: int):
+        super(GameChannel, self).__init__(client)
+
+        self.client = client
+        self.channel = channel
+        self.username = ""
+        self.inGame = False
+        self.ply = 0
+
+        self._handlers: Dict[ContentType, Callable[[Packet], None]] = {
+            WHITE_PLAYER_DATA: self.processPlayerData,
+            BLACK_PLAYER_DATA: self.processPlayerData,
+            PACKED_MOVE: self.processPackedMove,
+            RESYNC: self.processResync,
+            LEAVE: self.processLeave,
+            MESSAGE: self.processMessage,
+            SERVER_MESSAGE: lambda packet: self.serverMessageReceived.emit(packet.payload),
+            ERROR: lambda packet: self.serverError.emit(packet.payload),
+        }
+
+    def seek(self, username: str) -> int64:
+        """ Asks the server for an opponent, the game starts with `gameStarted`. """
+        self.username = username
+        return self.sendPacket(PLAYER_DATA, username)
+
+    def sendPacket(self, contentType: ContentType, payload: Union[str, bytes]) -> int64:
+        return self.client.sendChannelPacket(Packet(contentType, payload, channel=self.channel))
+
+    def sendMove(self, move: chess.Move, san: str, positionHash: int) -> int64:
+        payload = protocol.encodeMove(move.from_square, move.to_square, move.promotion or 0, self.ply, positionHash)
+        self.ply += 1
+        return self.sendPacket(PACKED_MOVE, payload)
+
+    def requestResync(self):
+        if self.inGame:
+            self.sendPacket(RESYNC, "")
+
+    def close(self):
+        """ Leaves the game, the connection and the other channels stay open. """
+        if self.client.closeChannel(self) and self.inGame:
+            self.sendPacket(LEAVE, "")
+        self.inGame = False
+
+    def processPacket(self, packet: Packet):
+        handler = self._handlers.get(packet.contentType)
+        if handler is not None:
+            handler(packet)
+
+    def processPlayerData(self, packet: Packet):
+        self.inGame = True
+        self.ply = 0
+        self.gameStarted.emit(packet)
+
+    def processPackedMove(self, packet: Packet):
+        try:
+            fromSquare, toSquare, promotion, ply, positionHash = protocol.decodeMove(packet.raw())
+        except protocol.ProtocolError:
+            return
+
+        self.ply = ply + 1
+        self.moveReceived.emit(chess.Move(fromSquare, toSquare, promotion or None), ply, positionHash,
+                               packet.receivedAt)
+
+    def processResync(self, packet: Packet):
+        ply, _, fen = packet.payload.partition(" ")
+        if ply.isdigit():
+            self.ply = int(ply)
+            self.resynced.emit(self.ply, fen)
+
+    def processLeave(self, packet: Packet):
+        self.inGame = False
+        self.left.emit()
+
+    def processMessage(self, packet: Packet):
+        if self.client.acceptMessage():
+            self.messageReceived.emit(packet.payload)
+
+
 class Client(QtCore.QObject):
+    """ The connection to the game server. The client can live on a thread of its own, see
+    `moveToThread`, so that reading and decoding frames never waits for the GUI. Its signals then
+    reach the GUI queued, and the methods that the GUI calls are queued the other way.
+
+    `moveReceived` carries the move, its ply, the hash of the position after it and the
+    `time.perf_counter()` at which its frame was read from the socket.
+    """
+    connected = QtCore.Signal()
+    disconnected = QtCore.Signal()
+    error = QtCore.Signal(QAbstractSocket.SocketError)
+    reconnecting = QtCore.Signal(int)
+    resumed = QtCore.Signal()
+    negotiated = QtCore.Signal()
+    latencyChanged = QtCore.Signal(float, float)
     gameStarted = QtCore.Signal(Packet)
     moveMade = QtCore.Signal(str)
+    moveReceived = QtCore.Signal(chess.Move, int, object, float)
+    resynced = QtCore.Signal(int, str)
+    spectating = QtCore.Signal(str, str)
+    snapshotReceived = QtCore.Signal(str, list)
+    left = QtCore.Signal()
     messageReceived = QtCore.Signal(str)
     serverMessageReceived = QtCore.Signal(str)
     serverError = QtCore.Signal(str)
+    # `inGame` for the other threads, which can't read it safely
+    inGameChanged = QtCore.Signal(bool)
+    _invoke = QtCore.Signal(object)
 
-    def __init__(self, username, parent=None):
+    def __init__(self, username, parent=None, serverDiscovery: Optional[discovery.ServerDiscovery] = None):
         super(Client, self).__init__(parent)
 
-        self.webClient = QtWebSockets.QWebSocket(
-            "", QtWebSockets.QWebSocketProtocol.VersionLatest, self)
+        self.serverDiscovery = serverDiscovery
+
+        # parented, so that it moves to the thread of the client, which is the only one to use it
+        self.settings = QtCore.QSettings(QtCore.QStandardPaths.writableLocation(
+            QtCore.QStandardPaths.ConfigLocation) + "/settings.ini", QtCore.QSettings.IniFormat, self)
+
+        self.webClient = self._newWebSocket()
+
+        # connection attempts racing for the server, see `startConnectionWithServer`
+        self._attempts: List[QtWebSockets.QWebSocket] = []
+        self._candidates = collections.deque()
+        self._cacheEndpoint = False
+        self._errorString = ""
+        self._attemptTimer = QtCore.QTimer(self)
+        self._attemptTimer.setSingleShot(True)
+        self._attemptTimer.setInterval(CONNECTION_ATTEMPT_DELAY)
+        self._attemptTimer.timeout.connect(self._nextAttempt)
+
+        # the state needed to resume the game after the connection is lost
+        self.resumeToken = ""
+        self._inGame = False
+        self.isSpectating = False
+        self.moves: List[Optional[Packet]] = []
+        self._pending: List[Packet] = []
+        self._reconnecting = False
+        self._reconnectAttempt = 0
+        self._reconnectUrl = ""
+        self._reconnectTimer = QtCore.QTimer(self)
+        self._reconnectTimer.setSingleShot(True)
+        self._reconnectTimer.timeout.connect(self.reconnect)
+
+        # smoothed round trip time and its mean deviation in ms, estimated as in RFC 6298
+        self.rtt = 0.0
+        self.jitter = 0.0
+        self._rttMeasured = False
+        self.deadTimeout = int(self.settings.value("network/deadTimeout", DEAD_TIMEOUT))
+        self._lastSeen = QtCore.QElapsedTimer()
+        self._heartbeatTimer = QtCore.QTimer(self)
+        self._heartbeatTimer.setInterval(HEARTBEAT_INTERVAL)
+        self._heartbeatTimer.timeout.connect(self.heartbeat)
+
+        # the games played over channels of this connection, see `openChannel`
+        self._channels: Dict[int, GameChannel] = {}
+        self._nextChannel = 1
+
+        # every frame sent and received goes to the recorder, see `startRecording`
+        self.recorder: Optional[recorder.WireRecorder] = None
+
+        # chat is paced by `chatBucket` and the excess is coalesced, see `_sendChat`, while the chat of
+        # the other side is dropped beyond `incomingChatBucket`, see `acceptMessage`
+        chatRate = float(self.settings.value("chat/rate", ratelimit.CHAT_RATE))
+        chatBurst = int(self.settings.value("chat/burst", ratelimit.CHAT_BURST))
+        self.chatBucket = ratelimit.TokenBucket(chatRate, chatBurst)
+        self.incomingChatBucket = ratelimit.TokenBucket(chatRate, chatBurst * ratelimit.RECEIVER_BURST_FACTOR)
+        self.droppedMessages = 0
+        self._chatBacklog: Deque[Packet] = collections.deque()
+        self._chatTimer = QtCore.QTimer(self)
+        self._chatTimer.setSingleShot(True)
+        self._chatTimer.timeout.connect(self._flushChat)
+
+        self.sendQueue = SendQueue(int(self.settings.value("network/highWatermark", HIGH_WATERMARK)),
+                                   int(self.settings.value("network/lowWatermark", LOW_WATERMARK)))
 
         self.username = username
-        self.functionMapper = {WHITE_PLAYER_DATA: self.processPlayerData,
-                               BLACK_PLAYER_DATA: self.processPlayerData,
-                               MOVE: self.processMove,
-                               MESSAGE: self.processMessage,
-                               SERVER_MESSAGE: self.processServerMessage,
-                               ERROR: self.processError}
+        self.protocolVersion = LEGACY_VERSION
 
-        self.webClient.connected.connect(self.authorize)
-        self.webClient.binaryMessageReceived.connect(self.processBinaryMessage)
+        # handlers and the number of received frames indexed by content type, see `processBinaryMessage`
+        self._handlers: List[Optional[Callable[[Packet], None]]] = [None] * 256
+        self.packetCounts = [0] * 256
+        self.registerHandler(PROTOCOL, self.processProtocol)
+        self.registerHandler(SESSION, self.processSession)
+        self.registerHandler(RESUMED, self.processResumed)
+        self.registerHandler(WHITE_PLAYER_DATA, self.processPlayerData)
+        self.registerHandler(BLACK_PLAYER_DATA, self.processPlayerData)
+        self.registerHandler(MOVE, self.processMove)
+        self.registerHandler(PACKED_MOVE, self.processPackedMove)
+        self.registerHandler(RESYNC, self.processResync)
+        self.registerHandler(SPECTATE, self.processSpectate)
+        self.registerHandler(SNAPSHOT, self.processSnapshot)
+        self.registerHandler(LEAVE, self.processLeave)
+        self.registerHandler(MESSAGE, self.processMessage)
+        self.registerHandler(SERVER_MESSAGE, self.processServerMessage)
+        self.registerHandler(ERROR, self.processError)
 
-    def startConnectionWithServer(self):
-        # retrieve local ip
-        local_hostname = socket.gethostname()
-        ip_addresses = socket.gethostbyname_ex(local_hostname)[2]
-        filtered_ips = [ip for ip in ip_addresses if not ip.startswith("127.")]
-        ip = filtered_ips[:1][0]
+        self.connected.connect(self.authorize)
+        self._invoke.connect(self._onInvoke)
 
-        self.webClient.open(QtCore.QUrl.fromUserInput(f"ws://{ip}:21166"))
+    @property
+    def inGame(self) -> bool:
+        return self._inGame
+
+    @inGame.setter
+    def inGame(self, inGame: bool):
+        if inGame != self._inGame:
+            self._inGame = inGame
+            self.inGameChanged.emit(inGame)
+
+    def _newWebSocket(self) -> QtWebSockets.QWebSocket:
+        webSocket = QtWebSockets.QWebSocket("", QtWebSockets.QWebSocketProtocol.VersionLatest, self)
+        webSocket.connected.connect(partial(self._onSocketConnected, webSocket))
+        webSocket.disconnected.connect(partial(self._onSocketDisconnected, webSocket))
+        webSocket.error.connect(partial(self._onSocketError, webSocket))
+        webSocket.binaryMessageReceived.connect(partial(self._onSocketMessage, webSocket))
+        webSocket.pong.connect(partial(self._onSocketPong, webSocket))
+        webSocket.bytesWritten.connect(partial(self._onSocketBytesWritten, webSocket))
+        return webSocket
+
+    def candidateUrls(self, discovered: Sequence[str] = ()) -> List[str]:
+        """ The endpoints to try: the `discovered` servers, least loaded first, the last successful one,
+        the configured hosts and then every local address. Nothing here resolves a name, Qt does it
+        asynchronously in `open`.
+        """
+        urls = list(discovered)
+
+        lastEndpoint = self.settings.value("network/lastEndpoint", "")
+        if lastEndpoint:
+            urls.append(lastEndpoint)
+
+        hosts = self.settings.value("network/hosts", [])
+        if isinstance(hosts, str):
+            hosts = [hosts]
+        for host in hosts:
+            urls.append(host if "://" in host else f"ws://{host}:{DEFAULT_PORT}")
+
+        loopback = []
+        for address in QNetworkInterface.allAddresses():
+            if address.isLoopback():
+                loopback.append(address)
+            elif address.protocol() == QAbstractSocket.IPv4Protocol:
+                urls.append(f"ws://{address.toString()}:{DEFAULT_PORT}")
+            elif address.protocol() == QAbstractSocket.IPv6Protocol and not address.isLinkLocal():
+                urls.append(f"ws://[{address.toString()}]:{DEFAULT_PORT}")
+
+        # a server on this machine is only tried when nothing else answers first
+        urls.append(f"ws://{QHostAddress(QHostAddress.LocalHost).toString()}:{DEFAULT_PORT}")
+
+        return list(dict.fromkeys(urls))
+
+    def startConnectionWithServer(self, url: str = ""):
+        """ Connects to `url` or, if it is empty, races connections to all the candidate endpoints
+        happy-eyeballs style: a new attempt starts every `CONNECTION_ATTEMPT_DELAY` ms or as soon as
+        the previous one fails, and the first one to complete the handshake wins.
+        """
+        # the discovered servers are ranked on the calling thread, which the server discovery lives in
+        discovered = []
+        if not url and self.serverDiscovery is not None:
+            discovered = [server.url() for server in self.serverDiscovery.rankedServers()]
+        self._connect(url, discovered)
+
+    @_onClientThread
+    def _connect(self, url: str, discovered: List[str]):
+        self.abortConnection()
+
+        self._cacheEndpoint = not url
+        self._candidates = collections.deque([url] if url else self.candidateUrls(discovered))
+        self._nextAttempt()
+
+    @_onClientThread
+    def close(self):
+        """ Leaves the game and closes the connection without trying to resume it. """
+        self.inGame = False
+        self.isSpectating = False
+        self.resumeToken = ""
+        self._reconnecting = False
+        self._reconnectTimer.stop()
+        self._pending.clear()
+        self._chatBacklog.clear()
+        self._chatTimer.stop()
+        self.sendQueue.clear()
+        self._heartbeatTimer.stop()
+        self.abortConnection()
+        self._dropChannels()
+        if self.recorder is not None:
+            self.recorder.flush()
+
+        if self.webClient.state() == QAbstractSocket.ConnectedState:
+            self.webClient.close()
+
+    @_onClientThread
+    def quitThread(self):
+        """ Stops the event loop of the thread the client lives in. Queued after `close`, it lets the
+        closing handshake reach the socket, so the server doesn't keep the seat for a resume. """
+        self.webClient.flush()
+        self.thread().quit()
+
+    def abortConnection(self):
+        self._attemptTimer.stop()
+        self._candidates.clear()
+        attempts, self._attempts = self._attempts, []
+        for webSocket in attempts:
+            webSocket.abort()
+            webSocket.deleteLater()
+
+    def errorString(self) -> str:
+        return self._errorString
+
+    @QtCore.Slot()
+    def _nextAttempt(self):
+        if not self._candidates:
+            return
+
+        url = self._candidates.popleft()
+        logging.debug(f"Connecting to {url}")
+
+        webSocket = self._newWebSocket()
+        self._attempts.append(webSocket)
+        webSocket.open(QtCore.QUrl.fromUserInput(url))
+
+        if self._candidates:
+            self._attemptTimer.start()
+
+    def _onSocketConnected(self, webSocket: QtWebSockets.QWebSocket):
+        if webSocket not in self._attempts:
+            return
+
+        self._attempts.remove(webSocket)
+        self.abortConnection()
+
+        if self.webClient is not webSocket:
+            self.webClient.deleteLater()
+            self.webClient = webSocket
+
+        url = webSocket.requestUrl().toString()
+        logging.debug(f"Connected to {url}")
+        if self._cacheEndpoint:
+            self.settings.setValue("network/lastEndpoint", url)
+
+        self.rtt = self.jitter = 0.0
+        self._rttMeasured = False
+        self._lastSeen.start()
+        self._heartbeatTimer.start()
+
+        if self._reconnecting:
+            self._send(Packet(RESUME, f"{self.resumeToken} {len(self.moves)}"))
+        else:
+            self.connected.emit()
+
+    def _onSocketError(self, webSocket: QtWebSockets.QWebSocket, error: QAbstractSocket.SocketError):
+        self._errorString = webSocket.errorString()
+
+        if webSocket in self._attempts:
+            self._attempts.remove(webSocket)
+            webSocket.deleteLater()
+
+            if self._candidates:
+                self._attemptTimer.stop()
+                self._nextAttempt()
+            elif not self._attempts:
+                if self._reconnecting:
+                    self._connectionLost()
+                else:
+                    self.error.emit(error)
+        elif webSocket is self.webClient:
+            if self._resumable():
+                self._connectionLost()
+            else:
+                self.error.emit(error)
+
+    def _onSocketDisconnected(self, webSocket: QtWebSockets.QWebSocket):
+        if webSocket is self.webClient:
+            self._heartbeatTimer.stop()
+            self._dropChannels()
+            if self._resumable():
+                self._connectionLost()
+            else:
+                self.disconnected.emit()
+
+    def _resumable(self) -> bool:
+        return self._reconnecting or (self.inGame and bool(self.resumeToken))
+
+    def _connectionLost(self):
+        if self._reconnectTimer.isActive() or self._attempts:
+            return
+
+        if self._reconnectAttempt >= RECONNECT_ATTEMPTS:
+            self._giveUp()
+            return
+
+        delay = min(RECONNECT_BASE_DELAY * 2 ** self._reconnectAttempt, RECONNECT_MAX_DELAY)
+        self._reconnecting = True
+        self._reconnectAttempt += 1
+        logging.debug(f"Connection lost, reconnecting in {delay} ms")
+
+        self._reconnectTimer.start(delay)
+        self.reconnecting.emit(self._reconnectAttempt)
+
+    def _giveUp(self):
+        logging.debug("Could not resume the game")
+        self.close()
+        self._reconnectAttempt = 0
+        self._errorString = "The connection to the server was lost"
+        self.error.emit(QAbstractSocket.RemoteHostClosedError)
+
+    @QtCore.Slot()
+    def reconnect(self):
+        """ Opens a new connection to the server of the game. Once it is established the session is
+        resumed with the token received in `SESSION` and the number of moves known by the client,
+        so that the server only sends a snapshot of the game if moves were missed.
+        """
+        self.startConnectionWithServer(self._reconnectUrl)
+
+    def _onSocketMessage(self, webSocket: QtWebSockets.QWebSocket, message: QtCore.QByteArray):
+        if webSocket is self.webClient:
+            self._lastSeen.start()
+            self.processBinaryMessage(message)
+
+    def _onSocketPong(self, webSocket: QtWebSockets.QWebSocket, elapsedTime: int, payload: QtCore.QByteArray):
+        if webSocket is not self.webClient:
+            return
+
+        self._lastSeen.start()
+
+        sample = float(elapsedTime)
+        if not self._rttMeasured:
+            self._rttMeasured = True
+            self.rtt = sample
+            self.jitter = sample / 2
+        else:
+            self.jitter = 0.75 * self.jitter + 0.25 * abs(self.rtt - sample)
+            self.rtt = 0.875 * self.rtt + 0.125 * sample
+
+        self.latencyChanged.emit(self.rtt, self.jitter)
+
+    def _onSocketBytesWritten(self, webSocket: QtWebSockets.QWebSocket, written: int):
+        if webSocket is self.webClient and self.sendQueue.depth():
+            self.sendQueue.pump(webSocket)
+
+    @QtCore.Slot()
+    def heartbeat(self):
+        """ Pings the server and aborts the connection when nothing, not even a pong, was received
+        for `deadTimeout` ms. A half-open connection is noticed long before the TCP timeout and
+        goes through the usual reconnection path.
+        """
+        if self.webClient.state() != QAbstractSocket.ConnectedState:
+            self._heartbeatTimer.stop()
+            return
+
+        if self._lastSeen.hasExpired(self.deadTimeout):
+            logging.debug(f"No heartbeat for {self._lastSeen.elapsed()} ms, the connection is dead")
+            self._heartbeatTimer.stop()
+            self._errorString = "The server stopped responding"
+            self.webClient.abort()
+            return
+
+        self.webClient.ping()
+        if self.recorder is not None:
+            self.recorder.flush()
+
+    @_onClientThread
+    def startRecording(self, path: str):
+        """ Appends the frames exchanged from now on to the log at `path`, which ``replay.py`` plays back. """
+        self.stopRecording()
+        try:
+            self.recorder = recorder.WireRecorder(path)
+        except OSError as e:
+            logging.warning(f"Can't record the traffic to {path}: {e}")
+
+    @_onClientThread
+    def stopRecording(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
 
     @QtCore.Slot()
     def authorize(self):
         logging.debug("Web client connected to server")
-        self.sendPacket(PLAYER_DATA, self.username)
+        # servers that know the compact format answer with a compact PROTOCOL packet,
+        # until then everything goes out in the legacy format
+        self.protocolVersion = LEGACY_VERSION
+        self.sendPacket(PROTOCOL, str(COMPACT_VERSION))
+        # without a username the games are played over channels, see `openChannel`
+        if self.username:
+            self.sendPacket(PLAYER_DATA, self.username)
 
+    @_onClientThread
     def sendPacket(self, contentType: ContentType, payload: str) -> int64:
-        packet = Packet(contentType, payload)
-        return self.webClient.sendBinaryMessage(packet.serialize())
+        return self._sendOrBuffer(Packet(contentType, payload))
+
+    @_onClientThread
+    def sendMove(self, move: chess.Move, san: str, positionHash: int) -> int64:
+        """ Sends a move of the player. Servers that speak the compact protocol get a `PACKED_MOVE`
+        with `positionHash`, the Zobrist hash of the position after the move, the others the san.
+        """
+        if self.protocolVersion == COMPACT_VERSION:
+            payload = protocol.encodeMove(move.from_square, move.to_square, move.promotion or 0,
+                                          len(self.moves), positionHash)
+            return self._sendOrBuffer(Packet(PACKED_MOVE, payload))
+        return self._sendOrBuffer(Packet(MOVE, san))
+
+    def openChannel(self) -> GameChannel:
+        """ Opens a channel for another game over this connection, which needs the compact protocol,
+        so `GameChannel.seek` has to wait for `negotiated`. """
+        channel = GameChannel(self, self._nextChannel)
+        self._channels[channel.channel] = channel
+        self._nextChannel += 1
+        return channel
+
+    def closeChannel(self, channel: GameChannel) -> bool:
+        """ Stops routing packets to `channel`, returns whether it was open. """
+        return self._channels.pop(channel.channel, None) is not None
+
+    def sendChannelPacket(self, packet: Packet) -> int64:
+        if self.protocolVersion != COMPACT_VERSION or self._reconnecting:
+            logging.warning(f"Dropping a packet of channel {packet.channel}, the connection can't carry channels")
+            return 0
+        return self._send(packet)
+
+    def _dropChannels(self):
+        channels, self._channels = self._channels, {}
+        for channel in channels.values():
+            if channel.inGame:
+                channel.inGame = False
+                channel.serverError.emit("The connection to the server was lost")
+
+    @_onClientThread
+    def watch(self, username: str = ""):
+        """ Asks to watch the game of `username` or any game if it is empty. Once `negotiated`, the
+        server answers with `spectating` and `snapshotReceived`, and then the moves of the game
+        arrive with `moveReceived`. A resumed game also catches up with `snapshotReceived`. """
+        self.sendPacket(WATCH, username)
+
+    @_onClientThread
+    def requestResync(self):
+        """ Asks the server for the position of the game, which arrives with `resynced` or, when
+        spectating, with `snapshotReceived`. """
+        if self.protocolVersion == COMPACT_VERSION and (self.inGame or self.isSpectating):
+            logging.debug(f"Requesting a resync at ply {len(self.moves)}")
+            self.sendPacket(RESYNC, "")
+
+    def _sendOrBuffer(self, packet: Packet) -> int64:
+        isMove = packet.contentType in (MOVE, PACKED_MOVE)
+        if isMove and self.inGame:
+            self.moves.append(packet)
+
+        if self._reconnecting:
+            # moves are sent again from `moves` once the server tells how many it has
+            if not isMove:
+                self._pending.append(packet)
+            return 0
+
+        return self._send(packet)
+
+    def _send(self, packet: Packet) -> int64:
+        if packet.contentType == MESSAGE:
+            return self._sendChat(packet)
+        return self._write(packet)
+
+    def _sendChat(self, packet: Packet) -> int64:
+        """ Sends a chat message if `chatBucket` has a token for it, otherwise it waits in the backlog
+        to be coalesced with the messages that follow it, see `_flushChat`. """
+        if not self._chatBacklog and self.chatBucket.take():
+            return self._write(packet)
+
+        self._chatBacklog.append(packet)
+        if not self._chatTimer.isActive():
+            self._chatTimer.start(max(1, math.ceil(self.chatBucket.delay() * 1000)))
+        return 0
+
+    @QtCore.Slot()
+    def _flushChat(self):
+        if self._reconnecting:
+            # sent again with the other pending packets once the game is resumed
+            self._pending.extend(self._chatBacklog)
+            self._chatBacklog.clear()
+            return
+
+        while self._chatBacklog and self.chatBucket.take():
+            self._write(self._coalesceChat())
+        if self._chatBacklog:
+            self._chatTimer.start(max(1, math.ceil(self.chatBucket.delay() * 1000)))
+
+    def _coalesceChat(self) -> Packet:
+        """ Joins the oldest messages of the backlog of the same channel into one that isn't longer
+        than `protocol.MAX_MESSAGE_LENGTH`. """
+        packet = self._chatBacklog.popleft()
+        lines = [packet.payload]
+        length = len(packet.payload)
+        while self._chatBacklog:
+            following = self._chatBacklog[0]
+            if following.channel != packet.channel or length + 1 + len(following.payload) > protocol.MAX_MESSAGE_LENGTH:
+                break
+            self._chatBacklog.popleft()
+            lines.append(following.payload)
+            length += 1 + len(following.payload)
+
+        if len(lines) == 1:
+            return packet
+        return Packet(MESSAGE, "\n".join(lines), channel=packet.channel)
+
+    def _write(self, packet: Packet) -> int64:
+        if self.protocolVersion == COMPACT_VERSION:
+            frame = QtCore.QByteArray(packet.encode())
+        else:
+            frame = packet.serialize()
+
+        if self.recorder is not None:
+            self.recorder.record(recorder.OUTGOING, memoryview(frame))
+
+        lane = CHAT_LANE if packet.contentType == MESSAGE else CONTROL_LANE
+        return self.sendQueue.push(self.webClient, frame, lane)
+
+    def processProtocol(self, packet: Packet):
+        if packet.payload.isdigit() and int(packet.payload) == COMPACT_VERSION:
+            logging.debug("Server accepted the compact protocol")
+            self.protocolVersion = COMPACT_VERSION
+            self.negotiated.emit()
+
+    def processSession(self, packet: Packet):
+        self.resumeToken = packet.payload
+
+    def processResumed(self, packet: Packet):
+        if not packet.payload.isdigit():
+            return
+
+        serverPly = int(packet.payload)
+        logging.debug(f"Game resumed at ply {serverPly}, {len(self.moves)} known locally")
+
+        self._reconnecting = False
+        self._reconnectAttempt = 0
+
+        # own moves that never reached the server
+        for packet in self.moves[serverPly:]:
+            if packet is not None:
+                self._send(packet)
+
+        pending, self._pending = self._pending, []
+        for packet in pending:
+            self._send(packet)
+
+        self.resumed.emit()
 
     def processPlayerData(self, packet: Packet):
+        self.inGame = True
+        self.moves = []
+        self._reconnectUrl = self.webClient.requestUrl().toString()
         self.gameStarted.emit(packet)
 
     def processMove(self, packet: Packet):
+        if self.inGame:
+            self.moves.append(packet)
         self.moveMade.emit(packet.payload)
 
+    def processPackedMove(self, packet: Packet):
+        try:
+            fromSquare, toSquare, promotion, ply, positionHash = protocol.decodeMove(packet.raw())
+        except protocol.ProtocolError:
+            return
+
+        if self.inGame:
+            self.moves.append(packet)
+        self.moveReceived.emit(chess.Move(fromSquare, toSquare, promotion or None), ply, positionHash,
+                               packet.receivedAt)
+
+    def processResync(self, packet: Packet):
+        ply, _, fen = packet.payload.partition(" ")
+        if not ply.isdigit():
+            return
+
+        # the moves before the resync are only counted from now on
+        ply = int(ply)
+        self.moves = self.moves[:ply] + [None] * (ply - len(self.moves))
+        self.resynced.emit(ply, fen)
+
+    def processSpectate(self, packet: Packet):
+        white, _, black = packet.payload.partition(" ")
+        self.isSpectating = True
+        self.spectating.emit(white, black)
+
+    def processSnapshot(self, packet: Packet):
+        try:
+            fen, moves = protocol.decodeSnapshot(packet.raw())
+        except protocol.ProtocolError:
+            return
+
+        if self.inGame:
+            # as after a resync, the moves of the snapshot are only counted
+            self.moves = self.moves[:len(moves)] + [None] * (len(moves) - len(self.moves))
+        self.snapshotReceived.emit(fen, [chess.Move(fromSquare, toSquare, promotion or None)
+                                         for fromSquare, toSquare, promotion in moves])
+
+    def processLeave(self, packet: Packet):
+        self.inGame = False
+        self.isSpectating = False
+        self.left.emit()
+
+    def acceptMessage(self) -> bool:
+        """ Tells whether a received chat message fits in `incomingChatBucket`, so that a flooding
+        opponent can't bury the GUI under message widgets. """
+        if self.incomingChatBucket.take():
+            return True
+        self.droppedMessages += 1
+        if self.droppedMessages == 1 or self.droppedMessages % 100 == 0:
+            logging.debug(f"Dropped {self.droppedMessages} chat messages sent too fast")
+        return False
+
     def processMessage(self, message):
-        self.messageReceived.emit(message.payload)
+        if self.acceptMessage():
+            self.messageReceived.emit(message.payload)
 
     def processServerMessage(self, message):
         self.serverMessageReceived.emit(message.payload)
 
     def processError(self, error):
+        if self._reconnecting:
+            self._giveUp()
+            return
         self.serverError.emit(error.payload)
 
+    def _routeToChannel(self, packet: Packet):
+        channel = self._channels.get(packet.channel)
+        if channel is not None:
+            channel.processPacket(packet)
+
+    def registerHandler(self, contentType: ContentType, handler: Optional[Callable[[Packet], None]]):
+        """ Makes `handler` process the received packets of `contentType`. Packets without a handler
+        are only counted. """
+        self._handlers[contentType] = handler
+
+    def counters(self) -> Dict[str, int]:
+        """ The number of received frames of each content type. """
+        names = protocol.CONTENT_TYPE_NAMES
+        return {names[contentType] if contentType < len(names) else str(contentType): count
+                for contentType, count in enumerate(self.packetCounts) if count}
+
+    @QtCore.Slot(object)
+    def _onInvoke(self, call: Callable[[], object]):
+        call()
+
     @QtCore.Slot()
     def processBinaryMessage(self, message: QtCore.QByteArray):
-        packet = Packet.deserialize(message)
-        if packet.contentType != NONE:
-            self.functionMapper[packet.contentType](packet)
+        receivedAt = time.perf_counter()
+        # the content type is read in place, nothing is copied for the frames nobody handles
+        view = memoryview(message).cast("B")
+        if self.recorder is not None:
+            self.recorder.record(recorder.INCOMING, view)
+
+        try:
+            contentType = protocol.peekContentType(view)
+        except protocol.ProtocolError as e:
+            logging.warning(f"Dropping malformed packet: {e}")
+            return
+
+        self.packetCounts[contentType] += 1
+        if protocol.peekFlags(view) & FLAG_CHANNEL:
+            handler = self._routeToChannel
+        else:
+            handler = self._handlers[contentType]
+        if handler is None:
+            return
+
+        # received packets may be kept, so they get their own copy of the frame
+        try:
+            packet = Packet.decode(view.tobytes())
+        except protocol.ProtocolError as e:
+            logging.warning(f"Dropping malformed packet: {e}")
+            return
+        packet.receivedAt = receivedAt
+
+        try:
+            handler(packet)
+        except UnicodeDecodeError as e:
+            logging.warning(f"Dropping malformed packet: {e}")
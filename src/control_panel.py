@@ -2,6 +2,10 @@ from PySide2.QtWidgets import QWidget, QLabel, QVBoxLayout, QHBoxLayout, QTableW
 from PySide2.QtCore import Qt, Slot
 from PySide2.QtGui import QIcon
 
+import chess
+
+from typing import List, Optional
+
 class GameControlPanel(QWidget):
     def __init__(self, first: str, second: str, parent=None):
         super(GameControlPanel, self).__init__(parent)
@@ -35,6 +39,8 @@ class GameControlPanel(QWidget):
         self.toolButtonsLayout.addStretch()
         self.toolButtonsLayout.setSpacing(14)
 
+        # the column of the first move, 1 if black moves first.
+        self.firstColumn = 0
         # the column that contains the first empty cell.
         self.nextColumn = 0
 
@@ -73,9 +79,11 @@ class GameControlPanel(QWidget):
         return (self.moveTable.currentRow() == self.moveTable.rowCount() - 1 and
                 self.moveTable.currentColumn() != self.nextColumn)
 
-    def reset(self):
+    def reset(self, turn: chess.Color = chess.WHITE):
+        """ Empties the table, the first move then goes in the column of `turn`. """
         self.moveTable.setRowCount(0)
-        self.nextColumn = 0
+        self.firstColumn = int(turn == chess.BLACK)
+        self.nextColumn = self.firstColumn
         self.toStartFenButton.setDisabled(True)
         self.previousMoveButton.setDisabled(True)
         self.nextMoveButton.setDisabled(True)
@@ -93,7 +101,7 @@ class GameControlPanel(QWidget):
             row = current.row()
             column = current.column()
 
-            if row == column == 0:
+            if row == 0 and column == self.firstColumn:
                 self.moveTable.setCurrentCell(-1, -1)
             else:
                 prevCoord = row * 2 + column - 1
@@ -107,7 +115,7 @@ class GameControlPanel(QWidget):
 
         if self.moveTable.rowCount():
             if current is None:
-                self.moveTable.setCurrentCell(0, 0)
+                self.moveTable.setCurrentCell(0, self.firstColumn)
             else:
                 row = current.row()
                 column = current.column()
@@ -120,7 +128,7 @@ class GameControlPanel(QWidget):
 
     def addMove(self, move: str) -> QTableWidgetItem:
         if self.isLive():
-            if not self.nextColumn:
+            if not self.nextColumn or not self.moveTable.rowCount():
                 self.moveTable.setRowCount(self.moveTable.rowCount() + 1)
 
         item = QTableWidgetItem(move)
@@ -130,6 +138,22 @@ class GameControlPanel(QWidget):
 
         return item
 
+    def addMoves(self, moves: List[str]) -> Optional[QTableWidgetItem]:
+        """ Appends `moves` to the table, which is resized only once. Returns the item of the last move. """
+        if not moves:
+            return None
+
+        # the index of the first empty cell, counted row by row
+        cell = self.moveTable.rowCount() * 2 - self.nextColumn if self.moveTable.rowCount() else self.nextColumn
+        self.moveTable.setRowCount((cell + len(moves) + 1) // 2)
+        item = None
+        for cell, move in enumerate(moves, cell):
+            item = QTableWidgetItem(move)
+            self.moveTable.setItem(cell // 2, cell % 2, item)
+
+        self.nextColumn = cell % 2 == 0
+        return item
+
     def popMove(self):
         if self.moveTable.rowCount():
             if self.isLive():
@@ -139,7 +163,7 @@ class GameControlPanel(QWidget):
 
             self.moveTable.takeItem(self.moveTable.rowCount() - 1, self.nextColumn)
 
-            if not self.nextColumn:
+            if not self.nextColumn or self.moveTable.rowCount() == 1 and self.nextColumn == self.firstColumn:
                 self.moveTable.setRowCount(self.moveTable.rowCount()-1)
 
     def swapNames(self):
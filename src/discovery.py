@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the HiChess project.
+# Copyright (C) 2019-2020 Haik Sargsian <haiksargsian6@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import PySide2.QtCore as QtCore
+from PySide2.QtNetwork import QUdpSocket, QHostAddress, QAbstractSocket
+
+import logging
+import time
+from typing import Dict, List, Tuple
+
+import protocol
+
+
+# servers that haven't announced themselves for this many seconds are forgotten
+SERVER_TTL = 5.0
+
+
+class ServerInfo:
+    __slots__ = ("host", "port", "load", "waiting", "expires")
+
+    def __init__(self, host: str, port: int, load: int, waiting: int, expires: float):
+        self.host = host
+        self.port = port
+        self.load = load
+        self.waiting = waiting
+        self.expires = expires
+
+    def url(self) -> str:
+        host = f"[{self.host}]" if ":" in self.host else self.host
+        return f"ws://{host}:{self.port}"
+
+
+class ServerDiscovery(QtCore.QObject):
+    """ Listens for the announcements that the servers broadcast on the local network and keeps
+    a table of the live ones, so that the client knows where to connect before it is asked to.
+    """
+
+    serversChanged = QtCore.Signal()
+
+    def __init__(self, ttl: float = SERVER_TTL, parent=None):
+        super(ServerDiscovery, self).__init__(parent)
+
+        self.ttl = ttl
+        self.servers: Dict[Tuple[str, int], ServerInfo] = {}
+
+        self.udpSocket = QUdpSocket(self)
+        self.udpSocket.readyRead.connect(self.readDatagrams)
+
+        self.evictionTimer = QtCore.QTimer(self)
+        self.evictionTimer.setInterval(int(ttl * 1000))
+        self.evictionTimer.timeout.connect(self.evict)
+
+    def start(self) -> bool:
+        """ Starts listening, returns False and leaves discovery off if the port can't be bound. """
+        # PySide2 5.13 overflows on or-ed enum flags, the mode is built from their values
+        mode = QAbstractSocket.BindMode(int(QAbstractSocket.ShareAddress) | int(QAbstractSocket.ReuseAddressHint))
+        try:
+            bound = self.udpSocket.bind(QHostAddress(QHostAddress.AnyIPv4), protocol.DISCOVERY_PORT, mode)
+        except (OverflowError, TypeError) as e:
+            logging.warning(f"Server discovery is disabled: {e}")
+            return False
+        if not bound:
+            logging.warning(f"Server discovery is disabled: {self.udpSocket.errorString()}")
+            return False
+
+        self.evictionTimer.start()
+        return True
+
+    @QtCore.Slot()
+    def readDatagrams(self):
+        changed = False
+        expires = time.monotonic() + self.ttl
+
+        while self.udpSocket.hasPendingDatagrams():
+            datagram = self.udpSocket.receiveDatagram()
+            try:
+                port, load, waiting = protocol.decodeAnnouncement(datagram.data().data())
+            except protocol.ProtocolError:
+                continue
+
+            host = datagram.senderAddress().toString()
+            key = (host, port)
+            server = self.servers.get(key)
+            if server is None:
+                logging.debug(f"Discovered a server at {host}:{port}")
+                self.servers[key] = ServerInfo(host, port, load, waiting, expires)
+                changed = True
+            else:
+                changed = changed or server.load != load or server.waiting != waiting
+                server.load, server.waiting, server.expires = load, waiting, expires
+
+        if changed:
+            self.serversChanged.emit()
+
+    @QtCore.Slot()
+    def evict(self):
+        now = time.monotonic()
+        expired = [key for key, server in self.servers.items() if server.expires < now]
+        for key in expired:
+            del self.servers[key]
+        if expired:
+            self.serversChanged.emit()
+
+    def rankedServers(self) -> List[ServerInfo]:
+        """ The live servers, least loaded first. Among equally loaded servers the ones with somebody
+        waiting for an opponent come first, as they can start a game right away.
+        """
+        self.evict()
+        return sorted(self.servers.values(), key=lambda server: (server.load, -server.waiting))
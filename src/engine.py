@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the HiChess project.
+# Copyright (C) 2019-2020 Haik Sargsian <haiksargsian6@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import PySide2.QtCore as QtCore
+
+import chess
+import chess.engine
+
+import asyncio
+import concurrent.futures
+import threading
+import logging
+import time
+from functools import partial
+from typing import Optional, Dict, List, Iterable
+
+
+class EnginePool(QtCore.QObject):
+    """ Keeps warm engine processes, so that starting a PvE game doesn't pay for spawning the engine,
+    the UCI handshake and the hash allocation. All the engines run on one asyncio event loop in a
+    background thread. Engines are taken with `acquire` and given back with `release`; the next game
+    on a released engine starts with ``ucinewgame`` instead of a new process.
+    """
+
+    def __init__(self, size: int = 1, parent=None):
+        super(EnginePool, self).__init__(parent)
+
+        self.size = size
+
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name="EnginePool", daemon=True)
+        self._thread.start()
+
+        self._idle: Dict[str, List[concurrent.futures.Future]] = {}
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def _popen(self, path: str) -> concurrent.futures.Future:
+        async def popen():
+            startTime = time.perf_counter()
+            transport, engine = await chess.engine.popen_uci(path)
+            await engine.ping()
+            logging.info(f"Engine at {path} started in {(time.perf_counter() - startTime) * 1000:.0f} ms.")
+            return engine
+
+        future = asyncio.run_coroutine_threadsafe(popen(), self.loop)
+        future.add_done_callback(partial(self._onPopenDone, path))
+        return future
+
+    def _onPopenDone(self, path: str, future: concurrent.futures.Future):
+        if not future.cancelled() and future.exception() is not None:
+            logging.error(f"Could not start the engine at {path}: {future.exception()!r}")
+
+    @staticmethod
+    def _alive(future: concurrent.futures.Future) -> bool:
+        if not future.done():
+            return True
+        return future.exception() is None and not future.result().returncode.done()
+
+    def warmUp(self, paths: Iterable[str]) -> None:
+        """ Starts `size` engines for each path in the background. """
+        for path in paths:
+            if not path:
+                continue
+            idle = self._idle.setdefault(path, [])
+            idle[:] = [future for future in idle if self._alive(future)]
+            while len(idle) < self.size:
+                idle.append(self._popen(path))
+
+    def acquire(self, path: str, options: dict = {}) -> concurrent.futures.Future:
+        """ Returns a future of a configured engine, reusing an idle one if there is any. """
+        idle = self._idle.get(path, [])
+        while idle:
+            future = idle.pop()
+            if self._alive(future):
+                break
+        else:
+            future = self._popen(path)
+
+        async def configure():
+            engine = await asyncio.wrap_future(future)
+            await engine.configure(options)
+            return engine
+
+        return asyncio.run_coroutine_threadsafe(configure(), self.loop)
+
+    def release(self, path: str, engineFuture: concurrent.futures.Future) -> None:
+        """ Gives an engine back to the pool. Engines above `size` and dead ones are quit. """
+        idle = self._idle.setdefault(path, [])
+
+        if len(idle) < self.size and self._alive(engineFuture):
+            idle.append(engineFuture)
+        else:
+            self._quit(engineFuture)
+
+    def _quit(self, engineFuture: concurrent.futures.Future) -> concurrent.futures.Future:
+        async def quit():
+            engine = await asyncio.wrap_future(engineFuture)
+            if not engine.returncode.done():
+                await engine.quit()
+
+        return asyncio.run_coroutine_threadsafe(quit(), self.loop)
+
+    def shutdown(self, timeout: float = 2.0) -> None:
+        """ Quits all the idle engines. """
+        futures = [self._quit(future) for idle in self._idle.values() for future in idle]
+        self._idle.clear()
+        concurrent.futures.wait(futures, timeout=timeout)
+
+
+class EngineWorker(QtCore.QObject):
+    """ Drop-in replacement for `hichess.EngineWrapper` that never blocks the caller.
+    The engine is borrowed from an `EnginePool` by `start` and given back by `quit`. `playMove` only
+    schedules a search, the result is delivered through `moveFound` in the thread that owns the worker.
+    """
+
+    moveFound = QtCore.Signal(object)
+    engineReady = QtCore.Signal(float)
+    _searchFinished = QtCore.Signal(int, object)
+    _engineStarted = QtCore.Signal(object, float)
+
+    def __init__(self, pool: EnginePool, parent=None):
+        super(EngineWorker, self).__init__(parent)
+
+        self.pool = pool
+        self.loop = pool.loop
+
+        self.path = ""
+        self.engine: Optional[concurrent.futures.Future] = None
+        self._game: Optional[object] = None
+        self._search: Optional[concurrent.futures.Future] = None
+        self._searchId = 0
+
+        self._searchFinished.connect(self._onSearchFinished)
+        self._engineStarted.connect(self._onEngineStarted)
+
+    def null(self) -> bool:
+        return self.engine is None
+
+    def searching(self) -> bool:
+        return self._search is not None and not self._search.done()
+
+    def start(self, path: str, options: dict = {}) -> bool:
+        if not self.null():
+            logging.warning("Cannot start a new engine, as there is another running.")
+            return False
+
+        self.path = path
+        # a new game token makes the engine receive ucinewgame before the first search
+        self._game = object()
+        self.engine = self.pool.acquire(path, options)
+
+        startTime = time.perf_counter()
+
+        def onDone(future: concurrent.futures.Future):
+            if not future.cancelled() and future.exception() is None:
+                self._engineStarted.emit(future, time.perf_counter() - startTime)
+
+        self.engine.add_done_callback(onDone)
+        return True
+
+    @QtCore.Slot(object, float)
+    def _onEngineStarted(self, engineFuture: concurrent.futures.Future, elapsed: float):
+        if engineFuture is self.engine:
+            self.engineReady.emit(elapsed)
+
+    def playMove(self, board: chess.Board, limit: chess.engine.Limit, ponder: bool) -> int:
+        """ Starts searching the best move on a copy of `board` and returns the id of the search.
+        A running search is cancelled first, so only the latest request can emit `moveFound`.
+        """
+        self.cancel()
+
+        engineFuture = self.engine
+        game = self._game
+        board = board.copy()
+
+        async def play():
+            engine = await asyncio.shield(asyncio.wrap_future(engineFuture))
+            return await engine.play(board=board, limit=limit, game=game, ponder=ponder)
+
+        searchId = self._searchId
+        self._search = asyncio.run_coroutine_threadsafe(play(), self.loop)
+        self._search.add_done_callback(lambda future: self._onSearchDone(searchId, future))
+        return searchId
+
+    def _onSearchDone(self, searchId: int, future: concurrent.futures.Future):
+        # runs in the engine thread, the signal is queued to the owner's thread
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            logging.error(f"Engine search failed: {future.exception()!r}")
+            return
+        self._searchFinished.emit(searchId, future.result().move)
+
+    @QtCore.Slot(int, object)
+    def _onSearchFinished(self, searchId: int, move: Optional[chess.Move]):
+        if searchId == self._searchId and move is not None:
+            self._search = None
+            self.moveFound.emit(move)
+
+    def cancel(self) -> bool:
+        """ Cancels the running search. Its result, if it is already on its way, is discarded. """
+        self._searchId += 1
+
+        if self._search is None:
+            return False
+
+        cancelled = self._search.cancel()
+        self._search = None
+        return cancelled
+
+    def quit(self) -> bool:
+        if self.null():
+            logging.warning("No engine is running.")
+            return False
+
+        self.cancel()
+        self.pool.release(self.path, self.engine)
+        self.engine = None
+        self._game = None
+        return True
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the HiChess project.
+# Copyright (C) 2019-2020 Haik Sargsian <haiksargsian6@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from typing import Callable, List, Optional, Tuple
+
+import chatwidget
+import engine
+
+
+class GameSession:
+    """ What the window sets up for a single game: the signal connections made for it, the engine
+    it is played against and its chat. `close` tears all of them down at once, so that nothing of
+    a game is left connected when the next one starts. The engine worker and the chat dock are
+    the window's, they are stopped and emptied rather than deleted.
+    """
+    def __init__(self, engineWorker: Optional[engine.EngineWorker] = None,
+                 chatWidget: Optional[chatwidget.ChatWidget] = None):
+        self.engineWorker = engineWorker
+        self.chatWidget = chatWidget
+        self.closed = False
+        self._connections: List[Tuple[object, Callable]] = []
+
+    def connectSignal(self, signal, slot: Callable):
+        """ Connects `signal` to `slot` until the session is closed. """
+        signal.connect(slot)
+        self._connections.append((signal, slot))
+
+    def connectionCount(self) -> int:
+        return len(self._connections)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+
+        connections, self._connections = self._connections, []
+        for signal, slot in reversed(connections):
+            try:
+                signal.disconnect(slot)
+            except RuntimeError:
+                # the sender is already gone or the slot was disconnected by hand
+                pass
+
+        if self.engineWorker is not None and not self.engineWorker.null():
+            self.engineWorker.quit()
+        self.engineWorker = None
+
+        # the chat dock belongs to the window and is reused by the next game
+        if self.chatWidget is not None:
+            self.chatWidget.close()
+            self.chatWidget.clear()
+            self.chatWidget = None
@@ -17,21 +17,30 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import PySide2.QtWidgets as QtWidgets
-from PySide2.QtCore import Qt, Slot, QEvent, QPoint
+from PySide2.QtCore import Qt, Slot, QEvent, QPoint, QSettings, QStandardPaths, QThread, QTimer
 from PySide2.QtGui import QPixmap, QIcon, QKeySequence, QResizeEvent
 from PySide2.QtNetwork import QAbstractSocket
 
 import hichess
 import chess
 import chess.engine
+import chess.polyglot
 
 import asyncio
+import logging
+import time
+from typing import List, Optional
 
 from functools import partial
 
 import client
+import engine
+import game_session
 import dialogs
+import discovery
+import latency
 import control_panel
+import premove_board
 import chatwidget
 
 import pyperclip
@@ -41,16 +50,20 @@ asyncio.set_event_loop_policy(chess.engine.EventLoopPolicy())
 
 
 class HichessGui(QtWidgets.QMainWindow):
-    def __init__(self, username: str, enginePath: str):
+    def __init__(self, username: str, enginePath: str, enginePool: engine.EnginePool):
         super(HichessGui, self).__init__()
 
         self.username = username
         self.enginePath = enginePath
+        self.enginePool = enginePool
 
         self.statusBar().show()
+        self.latencyLabel = QtWidgets.QLabel()
+        self.latencyLabel.hide()
+        self.statusBar().addPermanentWidget(self.latencyLabel)
 
         self.stackedWidget = QtWidgets.QStackedWidget()
-        self.boardWidget = hichess.BoardWidget(flipped=False, sides=hichess.BOTH_SIDES, dnd=True)
+        self.boardWidget = premove_board.PremoveBoardWidget(flipped=False, sides=hichess.BOTH_SIDES, dnd=True)
         self.boardWidget.setBoardPixmap(defaultPixmap=QPixmap(":/images/chessboard.png"),
                                         flippedPixmap=QPixmap(":/images/flipped_chessboard.png"))
         self.boardWidget.setFocusPolicy(Qt.StrongFocus)
@@ -59,6 +72,7 @@ class HichessGui(QtWidgets.QMainWindow):
         self.boardWidget.checkmate.connect(self.onCheckmate)
         self.boardWidget.draw.connect(self.onDraw)
         self.boardWidget.gameOver.connect(self.onGameOver)
+        self.boardWidget.movePushed.connect(self.onBoardMovePushed)
 
         self.controlPanelWidget = control_panel.GameControlPanel(self.username, self.username)
         self.controlPanelWidget.setMinimumWidth(100)
@@ -74,18 +88,75 @@ class HichessGui(QtWidgets.QMainWindow):
 
         self.gameLayout = QtWidgets.QGridLayout()
 
-        self.client = client.Client(self.username, self)
-
-        self.client.webClient.error.connect(self.onClientErrorReceived)
+        self.engineWorker = engine.EngineWorker(self.enginePool, self)
+        self.engineWorker.moveFound.connect(self.onEngineMoveFound)
+        self.engineWorker.engineReady.connect(self.onEngineReady)
+        self.pveColor = chess.WHITE
+        # the ply of the position the board was set to by the last resync
+        self.resyncPly = 0
+        # whether a resync was asked for because a snapshot didn't fit, so that a bad snapshot
+        # doesn't bring on a resync loop
+        self.snapshotResyncPending = False
+        # the launch of the engine, from the accepted dialog to `engineReady`, and from the
+        # request of the first search to its move
+        self.pveStartTime = None
+        self.engineReadyTime = 0.0
+        self.firstSearchTime = None
+        # the player whose game is watched, empty for any game, or None when not spectating
+        self.watchedUsername: Optional[str] = None
+
+        # listening from the start, so the servers are known when the user asks for an online game
+        self.serverDiscovery = discovery.ServerDiscovery(parent=self)
+        self.serverDiscovery.start()
+
+        # the client has settings of its own, a QSettings instance is not shared with its thread
+        settings = QSettings(QStandardPaths.writableLocation(QStandardPaths.ConfigLocation)
+                             + "/settings.ini", QSettings.IniFormat)
+
+        self.client = client.Client(self.username, serverDiscovery=self.serverDiscovery)
+        # `client.inGame` as seen by the GUI thread, see `onClientInGameChanged`
+        self.inGame = False
+        # the socket is read and the frames are decoded on a thread of their own, so that engine
+        # searches and repaints don't hold them up, unless network/thread is false
+        self.networkThread = QThread(self)
+        if str(settings.value("network/thread", True)).lower() != "false":
+            self.client.moveToThread(self.networkThread)
+            self.networkThread.finished.connect(self.client.deleteLater)
+            self.networkThread.start()
+        else:
+            self.client.setParent(self)
+        recordPath = settings.value("network/recordTo", "")
+        if recordPath:
+            self.client.startRecording(recordPath)
+        # from reading an opponent's move off the socket to showing it on the board
+        self.moveLatency = latency.LatencyHistogram("network to screen")
+
+        self.client.error.connect(self.onClientErrorReceived)
         self.client.serverError.connect(self.onServerError)
-        self.client.webClient.connected.connect(self.onClientConnected)
+        self.client.connected.connect(self.onClientConnected)
         self.client.gameStarted.connect(self.startGame)
         self.client.moveMade.connect(self.onClientMoveMade)
-        self.client.webClient.error.connect(self._onError)
+        self.client.moveReceived.connect(self.onClientMoveReceived)
+        self.client.resynced.connect(self.onClientResynced)
+        self.client.error.connect(self._onError)
+        self.client.reconnecting.connect(self.onClientReconnecting)
+        self.client.resumed.connect(self.onClientResumed)
+        self.client.latencyChanged.connect(self.onLatencyChanged)
+        self.client.negotiated.connect(self.onClientNegotiated)
+        self.client.spectating.connect(self.startSpectating)
+        self.client.snapshotReceived.connect(self.onClientSnapshotReceived)
+        self.client.left.connect(self.onClientLeft)
+        self.client.inGameChanged.connect(self.onClientInGameChanged)
         self.waitDialog = dialogs.WaitDialog(self)
         self.connectingDialog = dialogs.ConnectingDialog(self)
+        self.client.gameStarted.connect(self.waitDialog.accept)
 
-        self.chatWidget = chatwidget.ChatWidget()
+        # reused by every online game, see `startGame`
+        self.chatWidget = chatwidget.ChatWidget(historySize=int(settings.value(
+            "chat/history", chatwidget.HISTORY_SIZE)))
+
+        # what the current game connected and started, torn down by `endSession`
+        self.session: Optional[game_session.GameSession] = None
 
         self.toolbar = QtWidgets.QToolBar()
         self.backAction = QtWidgets.QAction(QIcon(":/images/back.png"), "Back")
@@ -127,20 +198,26 @@ class HichessGui(QtWidgets.QMainWindow):
         self.controlPanelWidget.reset()
         self.stackedWidget.setCurrentIndex(0)
 
-        if not self.boardWidget.engineWrapper.null():
-            self.toolbar.hide()
-            self.boardWidget.moveMade.disconnect(self.pveOnMoveMade)
-            self.boardWidget.engineWrapper.quit()
-
-        if self.client.webClient.state() == QAbstractSocket.ConnectedState:
-            self.client.webClient.close()
-        if self.chatWidget.isVisible():
-            self.chatWidget.close()
-            self.chatWidget = chatwidget.ChatWidget()
+        self.endSession()
+        self.client.close()
+        self.watchedUsername = None
+        self.latencyLabel.hide()
+        if self.moveLatency.count:
+            logging.info("\n".join([self.moveLatency.summary()] + self.moveLatency.lines()))
+            self.moveLatency.clear()
 
         self.removeDockWidget(self.chatWidget)
-        if not self.boardWidget.engineWrapper.null():
-            self.boardWidget.engineWrapper.quit()
+
+    def startSession(self, engineWorker: Optional[engine.EngineWorker] = None,
+                     chatWidget: Optional[chatwidget.ChatWidget] = None) -> game_session.GameSession:
+        self.endSession()
+        self.session = game_session.GameSession(engineWorker, chatWidget)
+        return self.session
+
+    def endSession(self):
+        if self.session is not None:
+            self.session.close()
+            self.session = None
 
     @Slot()
     def updateFullscreen(self):
@@ -173,22 +250,53 @@ class HichessGui(QtWidgets.QMainWindow):
     @Slot(str)
     def pveOnMoveMade(self, move):
         if not self.boardWidget.board.is_game_over():
-            color = (self.boardWidget.accessibleSides == hichess.ONLY_WHITE_SIDE)
-
-            if self.boardWidget.board.turn != color:
-                result = self.boardWidget.engineWrapper.playMove(self.boardWidget.board, chess.engine.Limit(time=0.1), True)
-                self.boardWidget.makeMove(result.move)
+            self.requestEngineMove(chess.engine.Limit(time=0.1), True)
         else:
-            if not self.boardWidget.engineWrapper.null():
-                self.boardWidget.moveMade.disconnect(self.pveOnMoveMade)
-                self.boardWidget.engineWrapper.quit()
+            self.endSession()
+
+    def requestEngineMove(self, limit: chess.engine.Limit, ponder: bool):
+        # the engine only searches the live position, never one the user is browsing
+        if self.engineWorker.null() or self.boardWidget.popStack or self.boardWidget.board.is_game_over():
+            return
+        if self.boardWidget.board.turn != self.pveColor:
+            if self.pveStartTime is not None:
+                # a new request cancels the previous search, so the clock restarts with it
+                self.firstSearchTime = time.perf_counter()
+            self.engineWorker.playMove(self.boardWidget.board, limit, ponder)
+
+    @Slot(object)
+    def onEngineMoveFound(self, move: chess.Move):
+        if not self.boardWidget.popStack and self.boardWidget.board.is_legal(move):
+            if self.pveStartTime is not None and self.firstSearchTime is not None:
+                # measured from the request, the time the user takes over their first move doesn't count
+                elapsed = (time.perf_counter() - self.firstSearchTime) * 1000
+                self.pveStartTime = None
+                logging.info(f"First engine move {elapsed:.0f} ms after it was requested")
+                self.statusBar().showMessage(f"Engine ready after {self.engineReadyTime:.0f} ms, "
+                                             f"first move after {elapsed:.0f} ms", timeout=4000)
+
+            self.boardWidget.makeMove(move)
+            self.boardWidget.playPremove()
+
+    @Slot(float)
+    def onEngineReady(self, elapsed: float):
+        if self.pveStartTime is not None:
+            self.engineReadyTime = (time.perf_counter() - self.pveStartTime) * 1000
+            logging.info(f"Engine ready {self.engineReadyTime:.0f} ms after the game was started")
 
     @Slot()
     def onClientConnected(self):
-        self.client.gameStarted.connect(self.waitDialog.accept)
         self.connectingDialog.close()
+        if self.watchedUsername is not None:
+            return
+
         self.waitDialog.exec_()
 
+    @Slot()
+    def onClientNegotiated(self):
+        if self.watchedUsername is not None:
+            self.client.watch(self.watchedUsername)
+
     @Slot()
     def onClientErrorReceived(self, error):
         self.connectingDialog.close()
@@ -197,12 +305,36 @@ class HichessGui(QtWidgets.QMainWindow):
             self.boardWidget.blockBoardOnPop = False
             self.controlPanelWidget.moveTable.setDisabled(True)
 
+    @Slot(int)
+    def onClientReconnecting(self, attempt):
+        self.latencyLabel.hide()
+        self.statusBar().showMessage(f"Connection lost, reconnecting (attempt {attempt})...")
+
+    @Slot()
+    def onClientResumed(self):
+        self.statusBar().showMessage("Reconnected", timeout=4000)
+
+    @Slot(float, float)
+    def onLatencyChanged(self, rtt, jitter):
+        self.latencyLabel.setText(f"Ping {rtt:.0f} ms ± {jitter:.0f}")
+        self.latencyLabel.setToolTip("Round trip time to the server and its jitter\n"
+                                     f"Moves shown {self.moveLatency.percentile(50):g} ms after they arrived, "
+                                     f"{self.moveLatency.percentile(95):g} ms at the 95th percentile")
+        self.latencyLabel.setVisible(self.inGame)
+
+    @Slot(bool)
+    def onClientInGameChanged(self, inGame):
+        self.inGame = inGame
+        if not inGame:
+            self.latencyLabel.hide()
+
     @Slot(str)
     def onServerError(self, error):
         QtWidgets.QMessageBox.critical(self, "Server", error)
         if self.waitDialog.isVisible():
             self.waitDialog.close()
-        self.client.webClient.abort()
+        self.client.close()
+        self.watchedUsername = None
 
     @Slot()
     def onCheckmate(self, side):
@@ -222,11 +354,10 @@ class HichessGui(QtWidgets.QMainWindow):
 
     @Slot()
     def onGameOver(self):
-        if self.client.webClient.state() == QAbstractSocket.ConnectedState:
-            self.client.webClient.close(0)
+        self.client.close()
 
-        if not self.boardWidget.engineWrapper.null():
-            self.boardWidget.engineWrapper.quit()
+        if not self.engineWorker.null():
+            self.engineWorker.quit()
 
     def setupMainMenuScene(self):
         menuScene = QtWidgets.QWidget()
@@ -234,18 +365,21 @@ class HichessGui(QtWidgets.QMainWindow):
         pveButton = QtWidgets.QPushButton("Against the Computer")
         offlinePvpButton = QtWidgets.QPushButton("Offline Pvp")
         onlinePvpButton = QtWidgets.QPushButton("Online PvP")
+        watchButton = QtWidgets.QPushButton("Watch a Game")
         settingsButton = QtWidgets.QPushButton("Settings")
         exitButton = QtWidgets.QPushButton("Exit")
 
         pveButton.setFixedSize(250, 40)
         offlinePvpButton.setFixedSize(250, 40)
         onlinePvpButton.setFixedSize(250, 40)
+        watchButton.setFixedSize(250, 40)
         settingsButton.setFixedSize(250, 40)
         exitButton.setFixedSize(250, 40)
 
         pveButton.clicked.connect(self.playPve)
         offlinePvpButton.clicked.connect(self.playOfflinePvp)
         onlinePvpButton.clicked.connect(self.playOnlinePvp)
+        watchButton.clicked.connect(self.watchGame)
         settingsButton.clicked.connect(self.settings)
         exitButton.clicked.connect(self.close)
 
@@ -253,6 +387,7 @@ class HichessGui(QtWidgets.QMainWindow):
         menuSceneLayout.addWidget(pveButton)
         menuSceneLayout.addWidget(offlinePvpButton)
         menuSceneLayout.addWidget(onlinePvpButton)
+        menuSceneLayout.addWidget(watchButton)
         menuSceneLayout.addWidget(settingsButton)
         menuSceneLayout.addWidget(exitButton)
         menuSceneLayout.setSpacing(20)
@@ -273,12 +408,13 @@ class HichessGui(QtWidgets.QMainWindow):
 
     @Slot()
     def toStartFen(self):
+        self.engineWorker.cancel()
         self.boardWidget.goToMove(0)
         self.controlPanelWidget.moveTable.setCurrentCell(-1, -1)
 
         if not self.boardWidget.blockBoardOnPop:
             self.controlPanelWidget.moveTable.setRowCount(0)
-            self.controlPanelWidget.nextColumn = 0
+            self.controlPanelWidget.nextColumn = self.controlPanelWidget.firstColumn
 
         if self.boardWidget.popStack:
             self.controlPanelWidget.toCurrentFenButton.setDisabled(False)
@@ -299,10 +435,12 @@ class HichessGui(QtWidgets.QMainWindow):
         if not self.boardWidget.popStack:
             self.controlPanelWidget.toCurrentFenButton.setDisabled(True)
             self.controlPanelWidget.nextMoveButton.setDisabled(True)
+            self.requestEngineMove(chess.engine.Limit(time=0.1), True)
 
     @Slot()
     def previousMove(self):
         if self.boardWidget.board.move_stack:
+            self.engineWorker.cancel()
             self.boardWidget.pop()
             if not self.boardWidget.blockBoardOnPop:
                 self.controlPanelWidget.popMove()
@@ -326,11 +464,14 @@ class HichessGui(QtWidgets.QMainWindow):
             if not self.boardWidget.popStack:
                 self.controlPanelWidget.toCurrentFenButton.setDisabled(True)
                 self.controlPanelWidget.nextMoveButton.setDisabled(True)
+                self.requestEngineMove(chess.engine.Limit(time=0.1), True)
 
     @Slot()
     def onCellClicked(self, row, column):
         if self.controlPanelWidget.moveTable.item(row, column):
-            moveNumber = row * 2 + column
+            moveNumber = row * 2 + column - self.controlPanelWidget.firstColumn
+            if moveNumber + 1 != len(self.boardWidget.board.move_stack):
+                self.engineWorker.cancel()
             self.boardWidget.goToMove(moveNumber+1)
 
         if not self.boardWidget.blockBoardOnPop and not self.controlPanelWidget.isLive():
@@ -347,6 +488,8 @@ class HichessGui(QtWidgets.QMainWindow):
                 if not self.boardWidget.popStack:
                     self.controlPanelWidget.toCurrentFenButton.setDisabled(True)
                     self.controlPanelWidget.nextMoveButton.setDisabled(True)
+                    if not self.engineWorker.searching():
+                        self.requestEngineMove(chess.engine.Limit(time=0.1), True)
 
                 if self.boardWidget.board.turn == chess.WHITE:
                     self.boardWidget.accessibleSides = hichess.ONLY_WHITE_SIDE
@@ -373,6 +516,9 @@ class HichessGui(QtWidgets.QMainWindow):
         res = pveDialog.exec_()
 
         if res == QtWidgets.QDialog.Accepted:
+            self.pveStartTime = time.perf_counter()
+            self.engineReadyTime = 0.0
+            self.firstSearchTime = None
             self.toolbar.show()
 
             self.boardWidget.blockBoardOnPop = True
@@ -381,11 +527,12 @@ class HichessGui(QtWidgets.QMainWindow):
             SKILL_LEVELS = [0, 4, 8, 12, 14, 16, 18, 20]
             fen, level, color = pveDialog.data.values()
 
-            self.boardWidget.engineWrapper.start(self.enginePath,
-                                          {"Skill level": SKILL_LEVELS[level]})
+            session = self.startSession(engineWorker=self.engineWorker)
+            self.engineWorker.start(self.enginePath, {"Skill level": SKILL_LEVELS[level]})
+            self.pveColor = color
 
             self.controlPanelWidget.firstName.setText(f"Stockfish {SKILL_LEVELS[level]}")
-            self.boardWidget.moveMade.connect(self.pveOnMoveMade)
+            session.connectSignal(self.boardWidget.moveMade, self.pveOnMoveMade)
 
             # color
             if color == chess.WHITE:
@@ -395,14 +542,10 @@ class HichessGui(QtWidgets.QMainWindow):
                 self.boardWidget.accessibleSides = hichess.ONLY_BLACK_SIDE
                 self.boardWidget.flipped = True
 
-            if self.boardWidget.board.turn != color:
-                result = self.boardWidget.engineWrapper.playMove(board=self.boardWidget.board,
-                                                          limit=chess.engine.Limit(time=60),
-                                                          ponder=level > 4)
-                self.boardWidget.makeMove(result.move)
-
             self.stackedWidget.setCurrentIndex(1)
 
+            self.requestEngineMove(chess.engine.Limit(time=60), level > 4)
+
     @Slot()
     def playOfflinePvp(self):
         self.toolbar.show()
@@ -413,15 +556,97 @@ class HichessGui(QtWidgets.QMainWindow):
 
     @Slot()
     def playOnlinePvp(self):
+        self.watchedUsername = None
         self.client.username = self.username
         self.client.startConnectionWithServer()
         self.connectingDialog.exec_()
 
     @Slot()
-    def startGame(self, packet: client.Packet):
+    def watchGame(self):
+        username, ok = QtWidgets.QInputDialog.getText(self, "Watch a Game",
+                                                      "Player to watch, leave empty for any game:")
+        if not ok:
+            return
+
+        self.watchedUsername = username.strip()
+        # without a username the client doesn't ask for an opponent
+        self.client.username = ""
+        self.client.startConnectionWithServer()
+        self.connectingDialog.exec_()
+
+    @Slot(str, str)
+    def startSpectating(self, white, black):
         self.toolbar.show()
+        self.resyncPly = 0
+        self.snapshotResyncPending = False
+
+        self.boardWidget.blockBoardOnPop = True
+        self.boardWidget.accessibleSides = hichess.NO_SIDE
+        self.controlPanelWidget.moveTable.setDisabled(False)
+
+        self.controlPanelWidget.firstName.setText(black)
+        self.controlPanelWidget.secondName.setText(white)
 
-        self.boardWidget.moveMade.connect(partial(self.client.sendPacket, client.MOVE))
+        self.stackedWidget.setCurrentIndex(1)
+        self.statusBar().showMessage(f"Watching {white} vs {black}", timeout=4000)
+
+    @Slot(str, list)
+    def onClientSnapshotReceived(self, fen, moves):
+        self.applySnapshot(fen, moves)
+
+    def applySnapshot(self, fen: str, moves: List[chess.Move]):
+        """ Sets up the game of `fen` and `moves` in one pass. The board and the move table are
+        repainted once, instead of once per move as `makeMove` does. """
+        try:
+            board = chess.Board(fen)
+        except ValueError:
+            logging.warning(f"Received a snapshot with an invalid fen {fen}")
+            return
+
+        sans = []
+        for move in moves:
+            if not board.is_legal(move):
+                # a partial position would disagree with the server, ask for the snapshot again
+                # unless this one already answered such a request
+                logging.warning(f"The snapshot contains an illegal move {move.uci()}")
+                if not self.snapshotResyncPending:
+                    self.snapshotResyncPending = True
+                    self.client.requestResync()
+                return
+            sans.append(board.san(move))
+            board.push(move)
+
+        self.snapshotResyncPending = False
+        self.resyncPly = 0
+        self.loadPosition(board, sans)
+
+    def loadPosition(self, board: chess.Board, sans: List[str]):
+        """ Replaces the board and the move table, which then holds `sans`, and repaints them once.
+        The first move goes in the column of the side to move in the root position of `board`. """
+        moveTable = self.controlPanelWidget.moveTable
+        self.boardWidget.setUpdatesEnabled(False)
+        moveTable.setUpdatesEnabled(False)
+        try:
+            self.boardWidget.loadBoard(board)
+            self.controlPanelWidget.reset(board.root().turn)
+            item = self.controlPanelWidget.addMoves(sans)
+            if item is not None:
+                moveTable.setCurrentCell(item.row(), item.column())
+        finally:
+            moveTable.setUpdatesEnabled(True)
+            self.boardWidget.setUpdatesEnabled(True)
+
+    @Slot()
+    def onClientLeft(self):
+        if self.watchedUsername is not None:
+            self.statusBar().showMessage("The game is over")
+            self.client.close()
+
+    @Slot()
+    def startGame(self, packet: client.Packet):
+        self.toolbar.show()
+        self.resyncPly = 0
+        self.snapshotResyncPending = False
 
         self.boardWidget.blockBoardOnPop = True
         self.controlPanelWidget.moveTable.setDisabled(False)
@@ -440,29 +665,97 @@ class HichessGui(QtWidgets.QMainWindow):
             self.boardWidget.accessibleSides = hichess.ONLY_BLACK_SIDE
             self.boardWidget.flip()
 
+        session = self.startSession(chatWidget=self.chatWidget)
         self.addDockWidget(Qt.LeftDockWidgetArea, self.chatWidget)
-        self.chatWidget.messageToBeSent.connect(partial(self.client.sendPacket, client.MESSAGE))
-        self.client.messageReceived.connect(partial(self.receiveMessage, chatwidget.OPPONENT))
-        self.client.serverMessageReceived.connect(partial(self.chatWidget.showMessage, chatwidget.SERVER))
+        self.chatWidget.show()
+        session.connectSignal(session.chatWidget.messageToBeSent, partial(self.client.sendPacket, client.MESSAGE))
+        session.connectSignal(self.client.messageReceived, partial(self.receiveMessage, chatwidget.OPPONENT))
+        session.connectSignal(self.client.serverMessageReceived, partial(self.receiveMessage, chatwidget.SERVER))
 
     @Slot()
     def receiveMessage(self, sender, message):
-        self.chatWidget.showMessage(sender, message)
+        if self.session is not None and self.session.chatWidget is not None:
+            self.session.chatWidget.showMessage(sender, message)
         # show notifiaction
 
+    @Slot(str)
+    def onBoardMovePushed(self, move):
+        # only the moves of the player are pushed, the opponent's moves are made with `makeMove`
+        if self.inGame:
+            board = self.boardWidget.board
+            self.client.sendMove(board.peek(), move, chess.polyglot.zobrist_hash(board))
+
+    def liveBoard(self) -> chess.Board:
+        """ The position of the game, also while the user is looking at a previous move. """
+        if not self.boardWidget.popStack:
+            return self.boardWidget.board
+
+        board = self.boardWidget.board.copy()
+        for move in reversed(self.boardWidget.popStack):
+            board.push(move)
+        return board
+
     @Slot(str)
     def onClientMoveMade(self, move):
+        # servers that don't speak the compact protocol send the san
+        try:
+            self.applyOpponentMove(self.liveBoard().parse_san(move))
+        except ValueError:
+            logging.warning(f"Received an invalid move {move}")
+
+    @Slot(chess.Move, int, object, float)
+    def onClientMoveReceived(self, move, ply, positionHash, receivedAt):
+        board = self.liveBoard()
+        if ply != len(board.move_stack) + self.resyncPly or not board.is_legal(move):
+            logging.warning(f"Received the move {move.uci()} at ply {ply}, which doesn't fit the board")
+            self.client.requestResync()
+            return
+
+        self.applyOpponentMove(move, positionHash)
+        # the timer fires once the event loop has gone through the repaint the move scheduled
+        QTimer.singleShot(0, partial(self.recordMoveLatency, receivedAt))
+
+    def recordMoveLatency(self, receivedAt: float):
+        self.moveLatency.record(time.perf_counter() - receivedAt)
+
+    @Slot(int, str)
+    def onClientResynced(self, ply, fen):
+        try:
+            board = chess.Board(fen)
+        except ValueError:
+            return
+
+        # the history before the resync is unknown, so the table starts over like the move stack
+        # of the board, the premoves and the moves being looked at are dropped with them
+        self.loadPosition(board, [])
+        self.resyncPly = ply
+        self.snapshotResyncPending = False
+        self.statusBar().showMessage("The board was resynchronized with the server", timeout=4000)
+
+    def applyOpponentMove(self, move: chess.Move, positionHash: Optional[int] = None):
+        board = self.liveBoard()
+        if not board.is_legal(move):
+            logging.warning(f"Received an illegal move {move.uci()}")
+            return
+
         if not self.boardWidget.popStack:
-            self.boardWidget.makeMove(self.boardWidget.board.parse_san(move))
-            self.updateMoveTable(move)
+            self.boardWidget.makeMove(move)
         else:
-            self.boardWidget.popStack.appendleft(chess.Move.from_uci(move))
-            self.controlPanelWidget.addMove(move)
+            self.controlPanelWidget.addMove(board.san(move))
+            self.boardWidget.popStack.appendleft(move)
+            board.push(move)
+
+        if positionHash is not None and chess.polyglot.zobrist_hash(board) != positionHash:
+            logging.warning(f"The position after {move.uci()} differs from the server's one")
+            self.client.requestResync()
+            return
+
+        # a queued move goes out before anything is repainted
+        self.boardWidget.playPremove()
 
     @Slot()
     def _onError(self):
-        QtWidgets.QMessageBox.critical(self, "Server",
-                                       self.client.webClient.errorString())
+        QtWidgets.QMessageBox.critical(self, "Server", self.client.errorString())
         self.waitDialog.close()
 
     def settings(self):
@@ -472,6 +765,7 @@ class HichessGui(QtWidgets.QMainWindow):
         if status == dialogs.SettingsDialog.Accepted:
             self.username = settingsDialog.newUsername
             self.enginePath = settingsDialog.newEnginePath
+            self.enginePool.warmUp([self.enginePath])
 
     def eventFilter(self, watched: QtWidgets.QWidget, event: QResizeEvent):
         if event.type() == QEvent.Type.Resize:
@@ -496,5 +790,13 @@ class HichessGui(QtWidgets.QMainWindow):
                 self.nextMove()
 
     def closeEvent(self, event):
-        if not self.boardWidget.engineWrapper.null():
-            self.boardWidget.engineWrapper.quit()
+        if not self.engineWorker.null():
+            self.engineWorker.quit()
+
+        # leave the game and stop the recorder on the network thread before it stops
+        self.client.close()
+        self.client.stopRecording()
+        if self.networkThread.isRunning():
+            self.client.quitThread()
+            self.networkThread.wait()
+        self.chatWidget.stopLayoutThread()
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the HiChess project.
+# Copyright (C) 2019-2020 Haik Sargsian <haiksargsian6@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+""" Latency histogram with power of two buckets, cheap enough to be filled on the GUI thread. """
+
+import math
+from typing import List
+
+# upper bounds of the buckets in ms, the last bucket takes everything above
+BUCKET_BOUNDS = [2 ** i for i in range(-2, 11)]
+
+
+class LatencyHistogram:
+    def __init__(self, name: str = ""):
+        self.name = name
+        self.counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def record(self, seconds: float):
+        ms = seconds * 1000
+        self.counts[self.bucket(ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.maximum = max(self.maximum, ms)
+
+    @staticmethod
+    def bucket(ms: float) -> int:
+        if ms <= BUCKET_BOUNDS[0]:
+            return 0
+        return min(math.ceil(math.log2(ms)) - int(math.log2(BUCKET_BOUNDS[0])), len(BUCKET_BOUNDS))
+
+    def percentile(self, p: float) -> float:
+        """ The upper bound in ms of the bucket that holds the `p`th percentile, at most the maximum. """
+        if not self.count:
+            return math.nan
+
+        rank = max(1, math.ceil(p / 100 * self.count))
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(BUCKET_BOUNDS[bucket], self.maximum) if bucket < len(BUCKET_BOUNDS) else self.maximum
+        return self.maximum
+
+    def mean(self) -> float:
+        return self.total / self.count if self.count else math.nan
+
+    def clear(self):
+        self.counts = [0] * len(self.counts)
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def summary(self) -> str:
+        return f"{self.name} n={self.count} p50 {self.percentile(50):g} ms p95 {self.percentile(95):g} ms " \
+               f"p99 {self.percentile(99):g} ms max {self.maximum:.1f} ms"
+
+    def lines(self, width: int = 40) -> List[str]:
+        """ The histogram as text, one line and bar per bucket. """
+        peak = max(self.counts) or 1
+        lines = []
+        lower = 0.0
+        for bucket, count in enumerate(self.counts):
+            upper = f"{BUCKET_BOUNDS[bucket]:g}" if bucket < len(BUCKET_BOUNDS) else "inf"
+            lines.append(f"{lower:>6g} - {upper:>6} ms {count:8d} {'#' * round(count / peak * width)}")
+            lower = BUCKET_BOUNDS[min(bucket, len(BUCKET_BOUNDS) - 1)]
+        return lines
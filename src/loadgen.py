@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the HiChess project.
+# Copyright (C) 2019-2020 Haik Sargsian <haiksargsian6@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+""" Headless load generator. Spawns bot players built on `client.Client` that play against
+each other through a server and reports latency percentiles and throughput.
+
+    python src/server.py &
+    python src/loadgen.py --url ws://127.0.0.1:21166 --players 200
+
+With ``--games-per-connection`` above 1 the bots share connections and play over channels.
+"""
+
+import PySide2.QtCore as QtCore
+
+import chess
+import chess.pgn
+import chess.polyglot
+
+import argparse
+import random
+import signal
+import sys
+import time
+import zlib
+from functools import partial
+from typing import List, Optional, Union
+
+import client
+from benchmark import percentile
+
+
+class Stats:
+    def __init__(self):
+        self.connectTimes: List[float] = []
+        self.moveRoundTrips: List[float] = []
+        self.packetsSent = 0
+        self.packetsReceived = 0
+        self.gamesFinished = 0
+        self.errors = 0
+
+
+class Bot(QtCore.QObject):
+    """ Plays one game, either the game of a `client.Client` or of one of its channels. """
+    finished = QtCore.Signal()
+
+    def __init__(self, game: Union[client.Client, client.GameChannel], stats: Stats, maxPlies: int,
+                 chatEvery: int, scripts: List[List[chess.Move]], rng: random.Random, parent=None):
+        super(Bot, self).__init__(parent)
+
+        self.game = game
+        self.stats = stats
+        self.maxPlies = maxPlies
+        self.chatEvery = chatEvery
+        self.scripts = scripts
+        self.rng = rng
+
+        self.board = chess.Board()
+        self.color = chess.WHITE
+        self.script: List[chess.Move] = []
+        self.openTime = 0.0
+        self.moveSentTime: Optional[float] = None
+        self.done = False
+
+        game.gameStarted.connect(self.onGameStarted)
+        game.moveReceived.connect(self.onMoveReceived)
+        game.serverError.connect(self.onServerError)
+        if isinstance(game, client.Client):
+            game.moveMade.connect(self.onMoveMade)
+        else:
+            game.left.connect(self.stop)
+
+    def send(self, contentType: client.ContentType, payload: str):
+        self.game.sendPacket(contentType, payload)
+        self.stats.packetsSent += 1
+
+    @QtCore.Slot(client.Packet)
+    def onGameStarted(self, packet: client.Packet):
+        self.color = packet.contentType == client.WHITE_PLAYER_DATA
+        self.board.reset()
+
+        if self.scripts:
+            names = "".join(sorted((self.game.username, packet.payload)))
+            self.script = self.scripts[zlib.crc32(names.encode()) % len(self.scripts)]
+
+        if self.color == chess.WHITE:
+            self.play()
+
+    @QtCore.Slot(str)
+    def onMoveMade(self, san: str):
+        try:
+            move = self.board.parse_san(san)
+        except ValueError:
+            move = chess.Move.null()
+        self.onMoveReceived(move, len(self.board.move_stack), None)
+
+    @QtCore.Slot(chess.Move, int, object, float)
+    def onMoveReceived(self, move: chess.Move, ply: int, positionHash: Optional[int], receivedAt: float = 0.0):
+        if self.moveSentTime is not None:
+            self.stats.moveRoundTrips.append(time.perf_counter() - self.moveSentTime)
+            self.moveSentTime = None
+
+        if not self.board.is_legal(move):
+            self.stats.errors += 1
+            self.stop()
+            return
+
+        self.board.push(move)
+        if positionHash is not None and positionHash != chess.polyglot.zobrist_hash(self.board):
+            self.stats.errors += 1
+            self.stop()
+            return
+
+        self.play()
+
+    @QtCore.Slot(str)
+    def onServerError(self, error: str):
+        self.stats.errors += 1
+        self.stop()
+
+    def play(self):
+        if self.board.is_game_over() or len(self.board.move_stack) >= self.maxPlies:
+            self.stats.gamesFinished += 1
+            self.stop()
+            return
+
+        ply = len(self.board.move_stack)
+        if ply < len(self.script) and self.board.is_legal(self.script[ply]):
+            move = self.script[ply]
+        else:
+            move = self.rng.choice(list(self.board.legal_moves))
+
+        san = self.board.san(move)
+        self.board.push(move)
+        self.moveSentTime = time.perf_counter()
+        self.game.sendMove(move, san, chess.polyglot.zobrist_hash(self.board))
+        self.stats.packetsSent += 1
+
+        if self.chatEvery and (ply // 2) % self.chatEvery == 0:
+            self.send(client.MESSAGE, f"{san} was my move number {ply // 2 + 1}")
+
+    @QtCore.Slot()
+    def stop(self):
+        if not self.done:
+            self.done = True
+            self.game.close()
+            self.finished.emit()
+
+
+class BotConnection(QtCore.QObject):
+    """ A connection that plays `games` games, over channels if there is more than one. """
+    finished = QtCore.Signal(int)
+
+    def __init__(self, usernames: List[str], stats: Stats, maxPlies: int, chatEvery: int,
+                 scripts: List[List[chess.Move]], rng: random.Random, parent=None):
+        super(BotConnection, self).__init__(parent)
+
+        self.usernames = usernames
+        self.stats = stats
+        self.openTime = 0.0
+        self.connected = False
+        self.reported = False
+        self.running = len(usernames)
+
+        multiplexed = len(usernames) > 1
+        self.client = client.Client("" if multiplexed else usernames[0], self)
+        self.client.connected.connect(self.onConnected)
+        self.client.disconnected.connect(self.onDisconnected)
+        self.client.error.connect(self.onDisconnected)
+        if multiplexed:
+            self.client.negotiated.connect(self.onNegotiated)
+
+        games = [self.client.openChannel() for _ in usernames] if multiplexed else [self.client]
+        self.bots = [Bot(game, stats, maxPlies, chatEvery, scripts, rng, self) for game in games]
+        for bot in self.bots:
+            bot.finished.connect(self.onBotFinished)
+
+    def start(self, url: str):
+        self.openTime = time.perf_counter()
+        self.client.startConnectionWithServer(url)
+
+    @QtCore.Slot()
+    def onConnected(self):
+        self.connected = True
+        self.stats.connectTimes.append(time.perf_counter() - self.openTime)
+        # PROTOCOL and PLAYER_DATA sent by Client.authorize
+        self.stats.packetsSent += 1 + bool(self.client.username)
+
+    @QtCore.Slot()
+    def onNegotiated(self):
+        for bot, username in zip(self.bots, self.usernames):
+            bot.game.seek(username)
+            self.stats.packetsSent += 1
+
+    @QtCore.Slot()
+    def onBotFinished(self):
+        self.running -= 1
+        if not self.running:
+            self.client.close()
+
+    @QtCore.Slot()
+    def onDisconnected(self):
+        for bot in self.bots:
+            bot.done = True
+        if not self.reported:
+            self.reported = True
+            self.stats.packetsReceived += sum(self.client.packetCounts)
+            if not self.connected:
+                self.stats.errors += 1
+            self.finished.emit(len(self.bots))
+
+
+def loadScripts(path: str) -> List[List[chess.Move]]:
+    scripts = []
+    with open(path) as pgn:
+        game = chess.pgn.read_game(pgn)
+        while game is not None:
+            scripts.append(list(game.mainline_moves()))
+            game = chess.pgn.read_game(pgn)
+    return scripts
+
+
+def report(stats: Stats, elapsed: float):
+    def ms(values, p):
+        return f"{percentile(values, p) * 1000:8.2f} ms"
+
+    print(f"duration            {elapsed:8.2f} s")
+    print(f"games finished      {stats.gamesFinished:8d}")
+    print(f"errors              {stats.errors:8d}")
+    print(f"packets sent        {stats.packetsSent:8d}  ({stats.packetsSent / elapsed:,.0f}/s)")
+    print(f"packets received    {stats.packetsReceived:8d}  ({stats.packetsReceived / elapsed:,.0f}/s)")
+    for name, values in (("connection setup", stats.connectTimes), ("move round trip", stats.moveRoundTrips)):
+        print(f"{name:<20}p50 {ms(values, 50)}  p95 {ms(values, 95)}  p99 {ms(values, 99)}  (n={len(values)})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="HiChess headless load generator")
+    parser.add_argument("--url", default="ws://127.0.0.1:21166")
+    parser.add_argument("-n", "--players", type=int, default=100, help="number of bot players, rounded up to even")
+    parser.add_argument("--plies", type=int, default=80, help="maximum number of plies per game")
+    parser.add_argument("--chat-every", type=int, default=5, help="send a chat message every N own moves, 0 to disable")
+    parser.add_argument("--ramp", type=float, default=1.0, help="milliseconds between two connection attempts")
+    parser.add_argument("--games-per-connection", type=int, default=1,
+                        help="games played over the channels of each connection")
+    parser.add_argument("--duration", type=float, default=0, help="stop after N seconds, 0 to wait for all games")
+    parser.add_argument("--pgn", help="play the games of this PGN file instead of random legal moves")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    app = QtCore.QCoreApplication(sys.argv)
+    signal.signal(signal.SIGINT, lambda *_: app.quit())
+
+    stats = Stats()
+    rng = random.Random(args.seed)
+    scripts = loadScripts(args.pgn) if args.pgn else []
+    playerCount = args.players + args.players % 2
+
+    usernames = [f"loadbot_{i:05d}" for i in range(playerCount)]
+    perConnection = max(args.games_per_connection, 1)
+    connections = [BotConnection(usernames[i:i + perConnection], stats, args.plies, args.chat_every, scripts, rng)
+                   for i in range(0, playerCount, perConnection)]
+    running = playerCount
+
+    def onConnectionFinished(bots: int):
+        global running
+        running -= bots
+        if not running:
+            app.quit()
+
+    for i, connection in enumerate(connections):
+        connection.finished.connect(onConnectionFinished)
+        QtCore.QTimer.singleShot(int(i * args.ramp), partial(connection.start, args.url))
+
+    if args.duration:
+        QtCore.QTimer.singleShot(int(args.duration * 1000), app.quit)
+
+    startTime = time.perf_counter()
+    app.exec_()
+    report(stats, time.perf_counter() - startTime)
@@ -21,6 +21,7 @@ from PySide2.QtCore import QFile, QTextStream, QSettings, QStandardPaths
 from PySide2.QtGui import QFontDatabase, QIcon
 from hichess_gui import HichessGui
 from dialogs import SettingsDialog
+from engine import EnginePool
 import logging
 import sys
 
@@ -57,11 +58,20 @@ if __name__ == "__main__":
     app.setStyleSheet(f"{breezeQss}{mainQss}")
 
     settingsDialog = SettingsDialog()
+
+    # engines are spawned in the background while the user is in the settings dialog
+    enginePool = EnginePool()
+    enginePool.warmUp(settingsDialog.engines)
+
     status = settingsDialog.exec_()
 
     if status == SettingsDialog.Accepted:
-        window = HichessGui(username=settingsDialog.newUsername, enginePath=settingsDialog.newEnginePath)
+        enginePool.warmUp([settingsDialog.newEnginePath])
+        window = HichessGui(username=settingsDialog.newUsername, enginePath=settingsDialog.newEnginePath,
+                            enginePool=enginePool)
         window.setMinimumSize(800, 800)
         window.showMaximized()
 
-    sys.exit(app.exec_())
+    exitCode = app.exec_()
+    enginePool.shutdown()
+    sys.exit(exitCode)
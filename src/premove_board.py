@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the HiChess project.
+# Copyright (C) 2019-2020 Haik Sargsian <haiksargsian6@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from PySide2.QtCore import Slot
+
+import hichess
+import chess
+
+from collections import deque
+from typing import Deque, Optional
+
+
+class PremoveBoardWidget(hichess.BoardWidget):
+    """ A `hichess.BoardWidget` on which the player of a single side can queue moves while it is the
+    opponent's turn. The queued moves are marked on the board and `playPremove` plays the first one
+    that is legal in the current position, as soon as the opponent's move has been made.
+
+    Attributes
+    ----------
+    premoves : Deque[`chess.Move`]
+        The queued moves, in the order they were made.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(PremoveBoardWidget, self).__init__(*args, **kwargs)
+
+        self.premoves: Deque[chess.Move] = deque()
+        self._premoveFrom: Optional[chess.Square] = None
+
+    def premoveColor(self) -> Optional[chess.Color]:
+        """ The color of the side that can queue moves or None if premoves are not possible,
+        as it is the case when both or none of the sides can be played. """
+        if self.accessibleSides == hichess.ONLY_WHITE_SIDE:
+            return chess.WHITE
+        if self.accessibleSides == hichess.ONLY_BLACK_SIDE:
+            return chess.BLACK
+        return None
+
+    def canPremove(self) -> bool:
+        color = self.premoveColor()
+        return color is not None and self.board.turn != color and not self.board.is_game_over() \
+            and not (self.blockBoardOnPop and self.popStack)
+
+    def premoveBoard(self) -> chess.Board:
+        """ The position the queued moves lead to if the opponent's moves don't interfere. """
+        board = self.board.copy(stack=False)
+        board.turn = self.premoveColor()
+        for move in self.premoves:
+            board.push(move)
+            board.turn = self.premoveColor()
+        return board
+
+    def premoveTargets(self, square: chess.Square):
+        """ Yields the squares the piece on `square` may go to after the queued moves. As the opponent
+        still has to move, squares occupied by own pieces, which may be captured, and diagonal pawn
+        moves to empty squares are included. """
+        board = self.premoveBoard()
+        piece = board.piece_at(square)
+        if piece is None or piece.color != board.turn:
+            return
+
+        targets = chess.SquareSet(move.to_square for move in board.pseudo_legal_moves
+                                  if move.from_square == square)
+        yield from targets | board.attacks(square)
+
+    def premove(self, move: chess.Move) -> None:
+        piece = self.premoveBoard().piece_at(move.from_square)
+        if piece is not None and piece.piece_type == chess.PAWN and move.promotion is None \
+                and chess.square_rank(move.to_square) in (0, 7):
+            move.promotion = chess.QUEEN
+
+        self.premoves.append(move)
+        self._showPremoves()
+
+    def cancelPremoves(self) -> None:
+        self.premoves.clear()
+        self._premoveFrom = None
+        self.unmarkCells()
+
+    def playPremove(self) -> Optional[str]:
+        """ Plays the first queued move that is legal in the current position and discards the
+        illegal ones before it. Called right after the opponent's move, the move is pushed, and
+        `movePushed` emitted, in the same event loop iteration.
+
+        The queued moves are discarded if the user is looking at a previous move, otherwise they
+        would be played later, in a position they weren't meant for.
+
+        Returns
+        -------
+        Optional[str]
+            The san of the played move or None if none of the queued moves could be played.
+        """
+        if self.blockBoardOnPop and self.popStack:
+            self.cancelPremoves()
+            return None
+        if self.board.turn != self.premoveColor():
+            return None
+
+        self._premoveFrom = None
+        while self.premoves:
+            move = self.premoves.popleft()
+            if self.board.is_legal(move):
+                san = self.board.san(move)
+                self.push(move)
+                self._showPremoves()
+                return san
+
+        self.unmarkCells()
+        return None
+
+    def loadBoard(self, board: chess.Board) -> None:
+        """ Replaces the board, move stack included, and synchronizes the widget once, however many
+        moves `board` has. The queued moves are discarded. """
+        self.cancelPremoves()
+        self._updateJustMovedCells(False)
+        self.popStack.clear()
+        self.board = board
+        self.unhighlightCells()
+        self.synchronizeAndUpdateStyles()
+
+    def reset(self) -> None:
+        self.premoves.clear()
+        self._premoveFrom = None
+        super(PremoveBoardWidget, self).reset()
+
+    def _showPremoves(self):
+        self.unmarkCells()
+        for move in self.premoves:
+            self.cellWidgetAtSquare(move.from_square).mark()
+            self.cellWidgetAtSquare(move.to_square).mark()
+
+    @Slot()
+    def _onCellWidgetClicked(self, w):
+        if self._premoveFrom is not None and w.highlighted:
+            fromSquare, self._premoveFrom = self._premoveFrom, None
+            self.foreachCells(hichess.CellWidget.unhighlight, lambda w: w.setChecked(False))
+            self.premove(chess.Move(fromSquare, self.squareOf(w)))
+            return
+
+        if self.premoves and not w.piece and not w.highlighted:
+            self.cancelPremoves()
+
+        super(PremoveBoardWidget, self)._onCellWidgetClicked(w)
+        # marking a cell unchecks the selected one
+        if self.premoves and not w.isChecked():
+            self._showPremoves()
+
+    @Slot()
+    def _onCellWidgetToggled(self, w: hichess.CellWidget, toggled: bool):
+        if not toggled or not self.canPremove() or w.getPiece() is None \
+                or w.getPiece().color != self.premoveColor():
+            self._premoveFrom = None
+            super(PremoveBoardWidget, self)._onCellWidgetToggled(w, toggled)
+            return
+
+        self.uncheckCells(exceptFor=w)
+        self.unhighlightCells()
+
+        square = self.squareOf(w)
+        targets = list(self.premoveTargets(square))
+        if not targets:
+            w.setChecked(False)
+            return
+
+        for target in targets:
+            self.cellWidgetAtSquare(target).highlight()
+        self._premoveFrom = square
+        self.lastCheckedCellWidget = w
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the HiChess project.
+# Copyright (C) 2019-2020 Haik Sargsian <haiksargsian6@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+""" Wire formats of the packets exchanged between the client and the server.
+This module doesn't depend on Qt, so that it can be shared by the client and the server.
+
+Legacy frames (version 1) are what `QDataStream` produces for a ``quint8`` content type followed
+by a ``QString``: a 32-bit big endian byte length and an UTF-16BE payload.
+
+Compact frames (version 2) start with one byte that holds the version with the high bit,
+`VERSION_MARKER`, set, which never happens in a legacy frame, followed by the content type, the
+flags, the varint channel if the `FLAG_CHANNEL` flag is set, the varint payload length and the
+UTF-8 payload::
+
+    | 0x80 + version | content type | flags | [varint channel] | varint length | payload |
+
+Channels let a connection take part in several games. A channel is chosen by the client when it
+asks for a game with `PLAYER_DATA`, and every packet of that game carries it. Packets without a
+channel, including all the legacy ones, belong to channel 0.
+
+Spectators send `WATCH` with the name of a player, or nothing for any game, and get a `SPECTATE`
+with the names of the players, a `SNAPSHOT` of the game and then its moves as `PACKED_MOVE`s.
+A player who resumes a game after missing moves catches up with a `SNAPSHOT` as well.
+
+The payload of every content type is text, except for the `BINARY_CONTENT_TYPES`.
+"""
+
+import struct
+from typing import Iterable, List, Tuple, Union
+
+
+CONTENT_TYPE_NAMES = ["NONE", "PLAYER_DATA", "WHITE_PLAYER_DATA", "BLACK_PLAYER_DATA", "MESSAGE", "SERVER_MESSAGE",
+                      "MOVE", "ERROR", "PROTOCOL", "SESSION", "RESUME", "RESUMED", "PACKED_MOVE", "RESYNC", "LEAVE",
+                      "WATCH", "SPECTATE", "SNAPSHOT"]
+[NONE, PLAYER_DATA, WHITE_PLAYER_DATA, BLACK_PLAYER_DATA, MESSAGE, SERVER_MESSAGE, MOVE, ERROR,
+ PROTOCOL, SESSION, RESUME, RESUMED, PACKED_MOVE, RESYNC, LEAVE,
+ WATCH, SPECTATE, SNAPSHOT] = range(len(CONTENT_TYPE_NAMES))
+
+# content types whose payload is raw bytes, they exist only in compact frames
+BINARY_CONTENT_TYPES = frozenset((PACKED_MOVE, SNAPSHOT))
+
+LEGACY_VERSION = 1
+COMPACT_VERSION = 2
+
+VERSION_MARKER = 0x80
+
+FLAG_CHANNEL = 0x01
+
+# characters of a chat message, longer ones are split by the sender
+MAX_MESSAGE_LENGTH = 1600
+
+DEFAULT_PORT = 21166
+DISCOVERY_PORT = 21167
+
+_compactHeader = struct.Struct(">BBB")
+_legacyHeader = struct.Struct(">BI")
+_NULL_STRING = 0xFFFFFFFF
+
+# packed move, ply of the move, Zobrist hash of the position after the move
+_packedMove = struct.Struct(">HHQ")
+
+# magic, WebSocket port, connected players, players waiting for an opponent
+_announcement = struct.Struct(">4sHIH")
+_ANNOUNCEMENT_MAGIC = b"HiC" + bytes((COMPACT_VERSION,))
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encodeVarint(value: int) -> bytes:
+    if value < 0x80:
+        return bytes((value,))
+
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def decodeVarint(buffer: memoryview, offset: int) -> Tuple[int, int]:
+    """ Returns the decoded value and the offset of the first byte after it. """
+    value = 0
+    shift = 0
+    while True:
+        if offset >= len(buffer):
+            raise ProtocolError("truncated varint")
+        byte = buffer[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+        if shift > 63:
+            raise ProtocolError("varint is too long")
+
+
+def frameVersion(frame: Union[bytes, memoryview]) -> int:
+    if not len(frame):
+        raise ProtocolError("empty frame")
+    if frame[0] & VERSION_MARKER:
+        return frame[0] & ~VERSION_MARKER
+    return LEGACY_VERSION
+
+
+def peekContentType(frame: Union[bytes, memoryview]) -> int:
+    """ The content type of a frame in either format, without decoding anything else. """
+    if not len(frame):
+        raise ProtocolError("empty frame")
+    if frame[0] & VERSION_MARKER:
+        if len(frame) < 2:
+            raise ProtocolError("truncated header")
+        return frame[1]
+    return frame[0]
+
+
+def peekFlags(frame: Union[bytes, memoryview]) -> int:
+    """ The flags of a compact frame or 0 for a legacy one. """
+    if len(frame) >= _compactHeader.size and frame[0] & VERSION_MARKER:
+        return frame[2]
+    return 0
+
+
+def encode(contentType: int, payload: Union[str, bytes] = b"", flags: int = 0, channel: int = 0) -> bytes:
+    if isinstance(payload, str):
+        payload = payload.encode("utf-8")
+    if channel:
+        flags |= FLAG_CHANNEL
+        return b"".join((_compactHeader.pack(VERSION_MARKER | COMPACT_VERSION, contentType, flags),
+                         encodeVarint(channel), encodeVarint(len(payload)), payload))
+    return b"".join((_compactHeader.pack(VERSION_MARKER | COMPACT_VERSION, contentType, flags & ~FLAG_CHANNEL),
+                     encodeVarint(len(payload)), payload))
+
+
+def decode(frame: Union[bytes, memoryview]) -> Tuple[int, int, int, memoryview]:
+    """ Decodes a compact frame and returns its content type, flags, channel and a view of the
+    raw payload. """
+    view = memoryview(frame)
+    if len(view) < _compactHeader.size:
+        raise ProtocolError("truncated header")
+
+    version, contentType, flags = _compactHeader.unpack_from(view)
+    if version != VERSION_MARKER | COMPACT_VERSION:
+        raise ProtocolError(f"unsupported version {version & ~VERSION_MARKER}")
+
+    channel = 0
+    offset = _compactHeader.size
+    if flags & FLAG_CHANNEL:
+        channel, offset = decodeVarint(view, offset)
+
+    length, offset = decodeVarint(view, offset)
+    if offset + length != len(view):
+        raise ProtocolError("payload length mismatch")
+
+    return contentType, flags, channel, view[offset:]
+
+
+def encodeLegacy(contentType: int, payload: str = "") -> bytes:
+    data = payload.encode("utf-16-be")
+    return _legacyHeader.pack(contentType, len(data)) + data
+
+
+def decodeLegacy(frame: Union[bytes, memoryview]) -> Tuple[int, str]:
+    contentType, payload = decodeLegacyView(frame)
+    return contentType, str(payload, "utf-16-be")
+
+
+def decodeLegacyView(frame: Union[bytes, memoryview]) -> Tuple[int, memoryview]:
+    """ Decodes a legacy frame and returns its content type and a view of the UTF-16BE payload. """
+    view = memoryview(frame)
+    if len(view) < _legacyHeader.size:
+        raise ProtocolError("truncated header")
+
+    contentType, length = _legacyHeader.unpack_from(view)
+    if length == _NULL_STRING:
+        return contentType, view[:0]
+    if _legacyHeader.size + length > len(view):
+        raise ProtocolError("payload length mismatch")
+
+    return contentType, view[_legacyHeader.size:_legacyHeader.size + length]
+
+
+def packMove(fromSquare: int, toSquare: int, promotion: int = 0) -> int:
+    """ Packs a move into 16 bits: 6 for each square and 3 for the promoted piece type, numbered
+    as in python-chess, or 0 if there is no promotion. """
+    return fromSquare | toSquare << 6 | promotion << 12
+
+
+def unpackMove(packed: int) -> Tuple[int, int, int]:
+    """ Returns the from-square, the to-square and the promotion of a packed move. """
+    return packed & 0x3F, packed >> 6 & 0x3F, packed >> 12 & 0x7
+
+
+def encodeMove(fromSquare: int, toSquare: int, promotion: int, ply: int, positionHash: int) -> bytes:
+    """ Encodes the payload of a `PACKED_MOVE`, `ply` is the number of moves made before this one
+    and `positionHash` the polyglot Zobrist hash of the position the move leads to. A receiver whose
+    position has a different hash asks for a `RESYNC`, which the server answers with the ply and
+    the FEN of the game.
+    """
+    return _packedMove.pack(packMove(fromSquare, toSquare, promotion), ply, positionHash)
+
+
+def decodeMove(payload: Union[bytes, memoryview]) -> Tuple[int, int, int, int, int]:
+    """ Returns the from-square, the to-square, the promotion, the ply and the position hash of
+    a `PACKED_MOVE`. """
+    if len(payload) != _packedMove.size:
+        raise ProtocolError("malformed move")
+
+    packed, ply, positionHash = _packedMove.unpack(payload)
+    return unpackMove(packed) + (ply, positionHash)
+
+
+def encodeSnapshot(fen: str, moves: Iterable[Tuple[int, int, int]]) -> bytes:
+    """ Encodes the payload of a `SNAPSHOT`: the varint length of the starting FEN, the FEN and the
+    moves made since, packed as in `packMove`. """
+    fen = fen.encode("ascii")
+    packed = [packMove(*move) for move in moves]
+    return b"".join((encodeVarint(len(fen)), fen, struct.pack(f">{len(packed)}H", *packed)))
+
+
+def decodeSnapshot(payload: Union[bytes, memoryview]) -> Tuple[str, List[Tuple[int, int, int]]]:
+    """ Returns the starting FEN and the unpacked moves of a `SNAPSHOT`. """
+    view = memoryview(payload)
+    length, offset = decodeVarint(view, 0)
+    if offset + length > len(view) or (len(view) - offset - length) % 2:
+        raise ProtocolError("malformed snapshot")
+
+    try:
+        fen = str(view[offset:offset + length], "ascii")
+    except UnicodeDecodeError:
+        raise ProtocolError("malformed snapshot")
+
+    count = (len(view) - offset - length) // 2
+    return fen, [unpackMove(packed) for packed in struct.unpack_from(f">{count}H", view, offset + length)]
+
+
+def encodeAnnouncement(port: int, load: int, waiting: int) -> bytes:
+    """ Encodes the datagram a server broadcasts to advertise itself on the local network. """
+    return _announcement.pack(_ANNOUNCEMENT_MAGIC, port, min(load, 0xFFFFFFFF), min(waiting, 0xFFFF))
+
+
+def decodeAnnouncement(datagram: Union[bytes, memoryview]) -> Tuple[int, int, int]:
+    """ Returns the port, the load and the number of waiting players of an announcement. """
+    if len(datagram) != _announcement.size:
+        raise ProtocolError("not an announcement")
+
+    magic, port, load, waiting = _announcement.unpack(datagram)
+    if magic != _ANNOUNCEMENT_MAGIC:
+        raise ProtocolError("not an announcement")
+
+    return port, load, waiting
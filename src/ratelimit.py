@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the HiChess project.
+# Copyright (C) 2019-2020 Haik Sargsian <haiksargsian6@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+""" Token buckets that limit how fast chat messages are sent and accepted. Like `protocol`, this
+module doesn't depend on Qt, so that it can be shared by the client and the server.
+
+A sender paces itself at `CHAT_RATE` messages per second with bursts of up to `CHAT_BURST`, and
+a receiver drops what goes beyond the same rate with twice the burst, which absorbs the jitter of
+the network, so that only clients that don't pace themselves lose messages.
+"""
+
+import time
+from typing import Callable
+
+CHAT_RATE = 2.0
+CHAT_BURST = 8
+RECEIVER_BURST_FACTOR = 2
+
+
+class TokenBucket:
+    """ Lets `rate` tokens per second through on average and up to `burst` at once. A `rate` that
+    isn't positive means no limit. """
+
+    def __init__(self, rate: float, burst: float, clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = float(burst)
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, tokens: float = 1) -> bool:
+        """ Takes `tokens` if there are enough of them and tells whether it did. """
+        if self.rate <= 0:
+            return True
+        self._refill()
+        if self.tokens < tokens:
+            return False
+        self.tokens -= tokens
+        return True
+
+    def delay(self, tokens: float = 1) -> float:
+        """ The seconds until `tokens` can be taken. """
+        if self.rate <= 0:
+            return 0.0
+        self._refill()
+        if self.tokens >= tokens:
+            return 0.0
+        return (tokens - self.tokens) / self.rate
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the HiChess project.
+# Copyright (C) 2019-2020 Haik Sargsian <haiksargsian6@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+""" Append-only binary log of the frames a `client.Client` exchanges with the server, which
+``replay.py`` feeds back into a client. Like `protocol`, this module doesn't depend on Qt.
+
+A log starts with a magic and is followed by records, each made of a header and the frame::
+
+    | direction | time.monotonic() as a big endian double | frame length | frame |
+
+A `MARK` record with an empty frame starts every recording session, as sessions are appended to
+the same log and their clocks are unrelated.
+"""
+
+import struct
+import time
+from typing import BinaryIO, Iterator, Tuple, Union
+
+[INCOMING, OUTGOING, MARK] = range(3)
+DIRECTION_NAMES = ["in", "out", "mark"]
+
+_MAGIC = b"HiCR\x01"
+_record = struct.Struct(">BdI")
+
+
+class RecordingError(Exception):
+    pass
+
+
+class WireRecorder:
+    def __init__(self, path: str):
+        self.path = path
+        self.frames = 0
+        self._file: BinaryIO = open(path, "ab")
+        if self._file.tell() == 0:
+            self._file.write(_MAGIC)
+        self.record(MARK, b"")
+
+    def record(self, direction: int, frame: Union[bytes, bytearray, memoryview]):
+        self._file.write(_record.pack(direction, time.monotonic(), len(frame)))
+        self._file.write(frame)
+        self.frames += 1
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def readRecording(path: str) -> Iterator[Tuple[int, float, bytes]]:
+    """ Yields the direction, the timestamp and the frame of every record of the log at `path`.
+    A record cut short, as the last one of a log whose writer crashed may be, ends the log. """
+    with open(path, "rb") as log:
+        if log.read(len(_MAGIC)) != _MAGIC:
+            raise RecordingError(f"{path} is not a wire recording")
+
+        while True:
+            header = log.read(_record.size)
+            if len(header) < _record.size:
+                return
+            direction, timestamp, length = _record.unpack(header)
+            frame = log.read(length)
+            if len(frame) < length:
+                return
+            yield direction, timestamp, frame
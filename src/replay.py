@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the HiChess project.
+# Copyright (C) 2019-2020 Haik Sargsian <haiksargsian6@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+""" Plays a wire recording, see `recorder`, back into a headless `client.Client`, either at the
+recorded pace, to reproduce what a user saw, or as fast as possible, to benchmark the decoding and
+the dispatch of real traffic. The frames the client sent are only listed.
+
+    python src/replay.py traffic.hcr --speed 1 -v
+    python src/replay.py traffic.hcr --fast
+"""
+
+import PySide2.QtCore as QtCore
+
+import argparse
+import logging
+import sys
+import time
+from typing import List, Tuple
+
+import client
+import protocol
+import recorder
+from benchmark import percentile
+
+
+def loadSessions(path: str) -> List[List[Tuple[int, float, bytes]]]:
+    """ The records of the log at `path`, split into recording sessions. """
+    sessions = []
+    for direction, timestamp, frame in recorder.readRecording(path):
+        if direction == recorder.MARK or not sessions:
+            sessions.append([])
+        if direction != recorder.MARK:
+            sessions[-1].append((direction, timestamp, frame))
+    return [session for session in sessions if session]
+
+
+def contentTypeName(frame: bytes) -> str:
+    try:
+        contentType = protocol.peekContentType(frame)
+    except protocol.ProtocolError:
+        return "malformed"
+    names = protocol.CONTENT_TYPE_NAMES
+    return names[contentType] if contentType < len(names) else str(contentType)
+
+
+def logEvents(webClient: client.Client, startTime: List[float]):
+    def log(event: str, *args):
+        logging.info(f"{time.perf_counter() - startTime[0]:9.3f} s  {event} {' '.join(map(str, args))}")
+
+    webClient.gameStarted.connect(lambda packet: log("game started against", packet.payload))
+    webClient.moveMade.connect(lambda san: log("move", san))
+    webClient.moveReceived.connect(lambda move, ply, positionHash, receivedAt: log("move", ply, move.uci()))
+    webClient.resynced.connect(lambda ply, fen: log("resync", ply, fen))
+    webClient.snapshotReceived.connect(lambda fen, moves: log("snapshot", fen, len(moves), "moves"))
+    webClient.spectating.connect(lambda white, black: log("spectating", white, "vs", black))
+    webClient.messageReceived.connect(lambda message: log("chat", message))
+    webClient.serverMessageReceived.connect(lambda message: log("server", message))
+    webClient.serverError.connect(lambda error: log("error", error))
+
+
+def replayFast(webClient: client.Client, session: List[Tuple[int, float, bytes]]) -> List[float]:
+    """ Feeds the received frames of `session` one after the other, returns the time each one took. """
+    durations = []
+    for direction, _, frame in session:
+        if direction != recorder.INCOMING:
+            continue
+        message = QtCore.QByteArray(frame)
+        startTime = time.perf_counter()
+        webClient.processBinaryMessage(message)
+        durations.append(time.perf_counter() - startTime)
+    return durations
+
+
+def replayTimed(app: QtCore.QCoreApplication, webClient: client.Client, session: List[Tuple[int, float, bytes]],
+                speed: float) -> List[float]:
+    """ Feeds the received frames of `session` at the recorded pace divided by `speed`. """
+    durations = []
+    origin = session[0][1]
+    startTime = time.perf_counter()
+
+    def feed(frame: bytes):
+        message = QtCore.QByteArray(frame)
+        feedTime = time.perf_counter()
+        webClient.processBinaryMessage(message)
+        durations.append(time.perf_counter() - feedTime)
+
+    for direction, timestamp, frame in session:
+        if direction == recorder.OUTGOING:
+            logging.debug(f"{(timestamp - origin) / speed:9.3f} s  sent {contentTypeName(frame)}")
+            continue
+        delay = (timestamp - origin) / speed - (time.perf_counter() - startTime)
+        QtCore.QTimer.singleShot(max(0, int(delay * 1000)), lambda frame=frame: feed(frame))
+
+    QtCore.QTimer.singleShot(int((session[-1][1] - origin) / speed * 1000) + 1, app.quit)
+    app.exec_()
+    return durations
+
+
+def positiveFloat(value: str) -> float:
+    try:
+        number = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value!r} is not a number")
+    if not number > 0:
+        raise argparse.ArgumentTypeError(f"{value} is not greater than 0")
+    return number
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replays a HiChess wire recording into a headless client")
+    parser.add_argument("recording")
+    parser.add_argument("--session", type=int, default=None, help="replay only the Nth recording session")
+    parser.add_argument("--speed", type=positiveFloat, default=1.0, help="replay speed relative to the recording")
+    parser.add_argument("--fast", action="store_true", help="replay as fast as possible")
+    parser.add_argument("-v", "--verbose", action="store_true", help="log the events the client emits")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING, format="%(message)s")
+    app = QtCore.QCoreApplication(sys.argv)
+
+    try:
+        sessions = loadSessions(args.recording)
+    except (OSError, recorder.RecordingError) as e:
+        sys.exit(e)
+    if args.session is not None:
+        sessions = sessions[args.session:args.session + 1]
+
+    for i, session in enumerate(sessions):
+        # a fresh client for every session, as every session is a fresh connection
+        webClient = client.Client("")
+        startTime = [time.perf_counter()]
+        if args.verbose:
+            logEvents(webClient, startTime)
+
+        if args.fast:
+            durations = replayFast(webClient, session)
+        else:
+            durations = replayTimed(app, webClient, session, args.speed)
+
+        received = len(durations)
+        total = sum(durations)
+        print(f"session {i}: {received} frames received, {len(session) - received} sent, "
+              f"{session[-1][1] - session[0][1]:.2f} s recorded")
+        if received and total:
+            print(f"  dispatch {received / total:,.0f} frames/s, "
+                  f"p50 {percentile(durations, 50) * 1e6:.1f} us, p99 {percentile(durations, 99) * 1e6:.1f} us")
+        print(f"  {webClient.counters()}")
@@ -0,0 +1,550 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the HiChess project.
+# Copyright (C) 2019-2020 Haik Sargsian <haiksargsian6@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+""" Reference game server for `client.Client`.
+Pairs the players in the order they authorize, checks and relays their moves and chat messages and
+tells a player when the opponent leaves. A connection can play several games, one per channel,
+see `protocol`, and watch games as a spectator. The server's load is broadcast on the local
+network, see `discovery.ServerDiscovery`.
+Everything runs on a single asyncio event loop.
+
+    python src/server.py --port 21166
+"""
+
+import asyncio
+import argparse
+import collections
+import logging
+import re
+import secrets
+from typing import Deque, Dict, List, Optional, Set, Union
+
+import chess
+import chess.polyglot
+import websockets
+
+import protocol
+import ratelimit
+from protocol import PLAYER_DATA, WHITE_PLAYER_DATA, BLACK_PLAYER_DATA, MESSAGE, SERVER_MESSAGE, MOVE, ERROR, \
+    PROTOCOL, SESSION, RESUME, RESUMED, PACKED_MOVE, RESYNC, LEAVE, WATCH, SPECTATE, SNAPSHOT, \
+    LEGACY_VERSION, COMPACT_VERSION, DEFAULT_PORT, DISCOVERY_PORT
+
+
+# a 1600 character chat chunk is at most 6400 bytes in UTF-8 and 3200 in UTF-16
+MAX_FRAME_SIZE = 16 * 1024
+# seconds between two broadcasts of the server's load, see `discovery.ServerDiscovery`
+ANNOUNCE_INTERVAL = 1.0
+# seconds a disconnected player has to resume the game, see `client.Client.reconnect`
+RESUME_GRACE = 60.0
+# normal closure and going away
+DELIBERATE_CLOSE_CODES = (1000, 1001)
+# bytes waiting in a spectator's socket above which the moves of the game are skipped for it and
+# the number of skipped moves after which the spectator is dropped, see `GameServer.broadcast`
+SPECTATOR_BACKLOG = 8 * 1024
+SPECTATOR_MAX_SKIPPED = 40
+
+USERNAME = re.compile(r"[A-Za-z0-9_]{6,16}")
+
+
+class Connection:
+    __slots__ = ("websocket", "version", "players", "spectators", "chatBucket", "chatThrottled")
+
+    def __init__(self, websocket, chatBucket: ratelimit.TokenBucket):
+        self.websocket = websocket
+        self.version = LEGACY_VERSION
+        self.players: Dict[int, Player] = {}
+        self.spectators: Dict[int, Spectator] = {}
+        # shared by all the games of the connection, see `GameServer.relayMessage`
+        self.chatBucket = chatBucket
+        self.chatThrottled = False
+
+
+class Player:
+    """ A seat in a game, played over the channel `channel` of `connection`, which is None while
+    the player is disconnected. """
+    __slots__ = ("connection", "channel", "username", "game", "color", "token", "graceTimer")
+
+    def __init__(self, connection: Connection, channel: int, username: str):
+        self.connection: Optional[Connection] = connection
+        self.channel = channel
+        self.username = username
+        self.game: Optional[Game] = None
+        self.color = True
+        self.token = ""
+        self.graceTimer: Optional[asyncio.TimerHandle] = None
+
+
+class Spectator:
+    """ Watches `game` over the channel `channel` of `connection`. `skipped` counts the moves it
+    missed because it didn't keep up. """
+    __slots__ = ("connection", "channel", "game", "skipped")
+
+    def __init__(self, connection: Connection, channel: int, game: "Game"):
+        self.connection = connection
+        self.channel = channel
+        self.game = game
+        self.skipped = 0
+
+
+class Game:
+    __slots__ = ("white", "black", "board", "spectators")
+
+    def __init__(self, white: Player, black: Player):
+        self.white = white
+        self.black = black
+        self.board = chess.Board()
+        self.spectators: List[Spectator] = []
+
+    def opponent(self, player: Player) -> Player:
+        return self.black if player is self.white else self.white
+
+    def ply(self) -> int:
+        return len(self.board.move_stack)
+
+
+class GameServer:
+    def __init__(self, chatRate: float = ratelimit.CHAT_RATE, chatBurst: int = ratelimit.CHAT_BURST):
+        self.chatRate = chatRate
+        self.chatBurst = chatBurst
+        self.queue: Deque[Player] = collections.deque()
+        self.sessions: Dict[str, Player] = {}
+        self.connections = 0
+        self.games: Set[Game] = set()
+
+    @staticmethod
+    def encode(connection: Connection, contentType: int, payload: Union[str, bytes], channel: int = 0) -> bytes:
+        if connection.version == COMPACT_VERSION:
+            return protocol.encode(contentType, payload, channel=channel)
+        return protocol.encodeLegacy(contentType, payload)
+
+    async def write(self, connection: Connection, contentType: int, payload: Union[str, bytes], channel: int = 0):
+        try:
+            await connection.websocket.send(self.encode(connection, contentType, payload, channel))
+        except websockets.ConnectionClosed:
+            pass
+
+    async def send(self, player: Player, contentType: int, payload: Union[str, bytes]):
+        if player.connection is not None:
+            await self.write(player.connection, contentType, payload, player.channel)
+
+    async def handler(self, websocket):
+        connection = Connection(websocket, ratelimit.TokenBucket(
+            self.chatRate, self.chatBurst * ratelimit.RECEIVER_BURST_FACTOR))
+        self.connections += 1
+        try:
+            async for frame in websocket:
+                if isinstance(frame, str):
+                    continue
+                try:
+                    if protocol.frameVersion(frame) == LEGACY_VERSION:
+                        contentType, payload = protocol.decodeLegacy(frame)
+                        channel = 0
+                    else:
+                        contentType, flags, channel, payload = protocol.decode(frame)
+                        if contentType not in protocol.BINARY_CONTENT_TYPES:
+                            payload = str(payload, "utf-8")
+                except (protocol.ProtocolError, UnicodeDecodeError) as e:
+                    logging.debug(f"Malformed frame from {websocket.remote_address}: {e}")
+                    continue
+                await self.dispatch(connection, contentType, channel, payload)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.connections -= 1
+            for spectator in list(connection.spectators.values()):
+                self.unwatch(spectator)
+            for player in list(connection.players.values()):
+                await self.disconnect(player, connection)
+
+    async def dispatch(self, connection: Connection, contentType: int, channel: int, payload):
+        if contentType == PROTOCOL:
+            if payload.isdigit() and int(payload) >= COMPACT_VERSION:
+                connection.version = COMPACT_VERSION
+                await self.write(connection, PROTOCOL, str(COMPACT_VERSION))
+            return
+        if contentType == PLAYER_DATA:
+            await self.authorize(connection, channel, payload)
+            return
+        if contentType == RESUME:
+            await self.resume(connection, channel, payload)
+            return
+        if contentType == WATCH:
+            await self.watch(connection, channel, payload)
+            return
+
+        spectator = connection.spectators.get(channel)
+        if spectator is not None:
+            if contentType == RESYNC:
+                await self.sendSnapshot(spectator)
+            elif contentType == LEAVE:
+                self.unwatch(spectator)
+            return
+
+        player = connection.players.get(channel)
+        if player is None:
+            if contentType in (MOVE, PACKED_MOVE):
+                await self.write(connection, ERROR, "It is not your turn", channel)
+        elif contentType in (MOVE, PACKED_MOVE):
+            await self.move(player, contentType, payload)
+        elif contentType == RESYNC:
+            if player.game is not None:
+                await self.resync(player)
+        elif contentType == MESSAGE:
+            if player.game is not None:
+                await self.relayMessage(player, payload)
+        elif contentType == LEAVE:
+            await self.leave(player)
+
+    async def relayMessage(self, player: Player, message: str):
+        """ Relays a chat message to the opponent unless the connection of `player` sends them faster
+        than its bucket allows. The sender is told once each time it starts being throttled. """
+        connection = player.connection
+        if not connection.chatBucket.take():
+            if not connection.chatThrottled:
+                connection.chatThrottled = True
+                await self.send(player, SERVER_MESSAGE, "You are sending messages too fast, some of them were dropped")
+            return
+
+        connection.chatThrottled = False
+        await self.send(player.game.opponent(player), MESSAGE, message)
+
+    async def authorize(self, connection: Connection, channel: int, username: str):
+        if channel in connection.players or channel in connection.spectators:
+            await self.write(connection, ERROR, "Already authorized", channel)
+            return
+        if not USERNAME.fullmatch(username):
+            await self.write(connection, ERROR, "Invalid username", channel)
+            return
+
+        player = Player(connection, channel, username)
+        connection.players[channel] = player
+
+        # only clients that negotiated the compact format know how to resume, and only the game of channel 0
+        if connection.version >= COMPACT_VERSION and not channel:
+            player.token = secrets.token_urlsafe(16)
+            self.sessions[player.token] = player
+            await self.send(player, SESSION, player.token)
+
+        # players who disconnect are removed from the queue by `leave`
+        if not self.queue:
+            self.queue.append(player)
+            return
+
+        opponent = self.queue.popleft()
+        await self.startGame(white=opponent, black=player)
+
+    async def move(self, player: Player, contentType: int, payload):
+        game = player.game
+        if game is None:
+            await self.send(player, ERROR, "It is not your turn")
+            return
+
+        if contentType == MOVE:
+            # legacy clients can't resync, so they are told what went wrong
+            if game.board.turn != player.color:
+                await self.send(player, ERROR, "It is not your turn")
+                return
+            try:
+                move = game.board.parse_san(payload)
+            except ValueError:
+                await self.send(player, ERROR, "Illegal move")
+                return
+            positionHash = None
+        else:
+            try:
+                fromSquare, toSquare, promotion, ply, positionHash = protocol.decodeMove(payload)
+            except protocol.ProtocolError:
+                return
+            move = chess.Move(fromSquare, toSquare, promotion or None)
+            if game.board.turn != player.color or ply != game.ply() or not game.board.is_legal(move):
+                # the client's board has diverged from the server's one
+                await self.resync(player)
+                return
+
+        # the board is updated before anything is awaited, so that the packets handled meanwhile see
+        # the move, and what is sent is worked out from it rather than from the shared board
+        san = game.board.san(move)
+        ply = game.ply()
+        game.board.push(move)
+        serverHash = chess.polyglot.zobrist_hash(game.board)
+        packedMove = protocol.encodeMove(move.from_square, move.to_square, move.promotion or 0, ply, serverHash)
+
+        await self.sendMove(game.opponent(player), san, packedMove)
+        await self.broadcast(game, packedMove)
+
+        if positionHash is not None and positionHash != serverHash:
+            await self.resync(player)
+
+    async def sendMove(self, player: Player, san: str, packedMove: bytes):
+        """ Sends a move as `packedMove` or, to a legacy client, as `san`. """
+        if player.connection is None:
+            return
+
+        if player.connection.version == COMPACT_VERSION:
+            await self.send(player, PACKED_MOVE, packedMove)
+        else:
+            await self.send(player, MOVE, san)
+
+    async def broadcast(self, game: Game, packedMove: bytes):
+        """ Sends `packedMove`, the last move of `game`, to its spectators. The frame is encoded once
+        per channel, usually just once, and written as is to every spectator.
+
+        A spectator that has more than `SPECTATOR_BACKLOG` bytes waiting in its socket skips moves,
+        so that it never holds up the game, and gets a snapshot once it has caught up. One that
+        skips more than `SPECTATOR_MAX_SKIPPED` moves in a row is dropped.
+        """
+        if not game.spectators:
+            return
+
+        frames: Dict[int, bytes] = {}
+
+        for spectator in list(game.spectators):
+            websocket = spectator.connection.websocket
+            if websocket.transport.get_write_buffer_size() > SPECTATOR_BACKLOG:
+                spectator.skipped += 1
+                if spectator.skipped > SPECTATOR_MAX_SKIPPED:
+                    logging.debug(f"Dropping a spectator of {game.white.username} vs {game.black.username}")
+                    self.unwatch(spectator)
+                    if not spectator.connection.players and not spectator.connection.spectators:
+                        asyncio.ensure_future(websocket.close())
+                continue
+
+            if spectator.skipped:
+                # the skipped moves are replaced by the current position
+                spectator.skipped = 0
+                await self.sendSnapshot(spectator)
+                continue
+
+            frame = frames.get(spectator.channel)
+            if frame is None:
+                frame = frames[spectator.channel] = protocol.encode(PACKED_MOVE, packedMove, channel=spectator.channel)
+            try:
+                await websocket.send(frame)
+            except websockets.ConnectionClosed:
+                pass
+
+    async def watch(self, connection: Connection, channel: int, username: str):
+        """ Makes `channel` of `connection` a spectator of the game of `username` or, if it is empty,
+        of any game. """
+        if connection.version != COMPACT_VERSION:
+            await self.write(connection, ERROR, "Watching a game needs a newer client", channel)
+            return
+        if channel in connection.players or channel in connection.spectators:
+            await self.write(connection, ERROR, "Already authorized", channel)
+            return
+
+        game = next((game for game in self.games if not username
+                     or username in (game.white.username, game.black.username)), None)
+        if game is None:
+            await self.write(connection, ERROR, "There is no such game", channel)
+            return
+
+        spectator = Spectator(connection, channel, game)
+        game.spectators.append(spectator)
+        connection.spectators[channel] = spectator
+
+        await self.write(connection, SPECTATE, f"{game.white.username} {game.black.username}", channel)
+        await self.sendSnapshot(spectator)
+
+    @staticmethod
+    def unwatch(spectator: Spectator):
+        spectator.connection.spectators.pop(spectator.channel, None)
+        try:
+            spectator.game.spectators.remove(spectator)
+        except ValueError:
+            pass
+
+    async def sendSnapshot(self, receiver: Union[Player, Spectator]):
+        """ Sends the whole game in a single `SNAPSHOT`, which the client applies in one go. """
+        if receiver.connection is None:
+            return
+
+        board = receiver.game.board
+        payload = protocol.encodeSnapshot(board.root().fen(), ((move.from_square, move.to_square, move.promotion or 0)
+                                                               for move in board.move_stack))
+        await self.write(receiver.connection, SNAPSHOT, payload, receiver.channel)
+
+    async def resync(self, player: Player):
+        board = player.game.board
+        logging.debug(f"Resynchronizing {player.username} at ply {len(board.move_stack)}")
+        await self.send(player, RESYNC, f"{len(board.move_stack)} {board.fen()}")
+
+    async def startGame(self, white: Player, black: Player):
+        game = Game(white, black)
+        white.game = black.game = game
+        white.color = True
+        black.color = False
+        self.games.add(game)
+
+        logging.debug(f"{white.username} vs {black.username}, {len(self.games)} games, {self.connections} connections")
+
+        await self.send(white, WHITE_PLAYER_DATA, black.username)
+        await self.send(black, BLACK_PLAYER_DATA, white.username)
+
+    async def disconnect(self, player: Player, connection: Connection):
+        if player.connection is not connection:
+            # the player has already resumed on another connection
+            return
+
+        # a closing handshake means that the player has left on purpose, otherwise keep the seat
+        game = player.game
+        if game is None or not player.token or connection.websocket.close_code in DELIBERATE_CLOSE_CODES \
+                or game.opponent(player).connection is None:
+            await self.leave(player)
+            return
+
+        connection.players.pop(player.channel, None)
+        player.connection = None
+        player.graceTimer = asyncio.get_running_loop().call_later(
+            RESUME_GRACE, lambda: asyncio.ensure_future(self.leave(player)))
+        await self.send(game.opponent(player), SERVER_MESSAGE, f"{player.username} lost the connection")
+
+    async def resume(self, connection: Connection, channel: int, payload: str):
+        """ Moves the session named in `payload` to `channel` of `connection` and, if it missed moves,
+        sends a snapshot of the game. """
+        token, _, ply = payload.partition(" ")
+        session = self.sessions.get(token)
+        if session is None or session.game is None or channel in connection.players or not ply.isdigit():
+            await self.write(connection, ERROR, "The game can't be resumed", channel)
+            return
+
+        if session.graceTimer is not None:
+            session.graceTimer.cancel()
+            session.graceTimer = None
+
+        # tokens are only given to compact clients, which don't negotiate again when resuming
+        connection.version = COMPACT_VERSION
+
+        oldConnection, oldChannel = session.connection, session.channel
+        if oldConnection is not None:
+            oldConnection.players.pop(oldChannel, None)
+        session.connection = connection
+        session.channel = channel
+        connection.players[channel] = session
+
+        if oldConnection is not None and oldConnection is not connection \
+                and not oldConnection.players and not oldConnection.spectators:
+            # the old connection is usually half-open, a close handshake would only wait for its timeout
+            oldConnection.websocket.transport.abort()
+
+        board = session.game.board
+        await self.send(session, RESUMED, str(len(board.move_stack)))
+        if int(ply) < len(board.move_stack):
+            await self.sendSnapshot(session)
+
+        await self.send(session.game.opponent(session), SERVER_MESSAGE, f"{session.username} is back")
+
+    async def leave(self, player: Player):
+        try:
+            self.queue.remove(player)
+        except ValueError:
+            pass
+
+        self.sessions.pop(player.token, None)
+        if player.graceTimer is not None:
+            player.graceTimer.cancel()
+            player.graceTimer = None
+        if player.connection is not None and player.connection.players.get(player.channel) is player:
+            del player.connection.players[player.channel]
+
+        game = player.game
+        if game is None:
+            return
+
+        self.games.discard(game)
+        opponent = game.opponent(player)
+        game.white.game = game.black.game = None
+        self.sessions.pop(opponent.token, None)
+        if opponent.graceTimer is not None:
+            opponent.graceTimer.cancel()
+            opponent.graceTimer = None
+
+        await self.send(opponent, SERVER_MESSAGE, f"{player.username} left the game")
+        if opponent.token:
+            # an empty token tells the client not to try to resume the game
+            await self.send(opponent, SESSION, "")
+
+        spectators, game.spectators = game.spectators, []
+        for spectator in spectators:
+            spectator.connection.spectators.pop(spectator.channel, None)
+            await self.write(spectator.connection, SERVER_MESSAGE, f"{player.username} left the game",
+                             spectator.channel)
+            await self.write(spectator.connection, LEAVE, "", spectator.channel)
+
+        connection = opponent.connection
+        if connection is None:
+            return
+        # the other games and spectators of the connection go on
+        connection.players.pop(opponent.channel, None)
+        await self.send(opponent, LEAVE, "")
+        if not connection.players and not connection.spectators:
+            asyncio.ensure_future(connection.websocket.close())
+
+    async def announce(self, port: int, interval: float):
+        """ Broadcasts the load of the server on the local network every `interval` seconds. """
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(
+            asyncio.DatagramProtocol, local_addr=("0.0.0.0", 0), allow_broadcast=True)
+        try:
+            while True:
+                transport.sendto(protocol.encodeAnnouncement(port, self.connections, len(self.queue)),
+                                 ("255.255.255.255", DISCOVERY_PORT))
+                await asyncio.sleep(interval)
+        finally:
+            transport.close()
+
+    async def serve(self, host: str, port: int, announceInterval: float = ANNOUNCE_INTERVAL):
+        async with websockets.serve(self.handler, host, port, max_size=MAX_FRAME_SIZE, compression=None):
+            logging.info(f"Listening on ws://{host}:{port}")
+            if announceInterval > 0:
+                await self.announce(port, announceInterval)
+            else:
+                await asyncio.Future()
+
+
+def _raiseFileLimit():
+    try:
+        import resource
+    except ImportError:
+        return
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="HiChess game server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--announce-interval", type=float, default=ANNOUNCE_INTERVAL,
+                        help="seconds between two LAN announcements, 0 to disable")
+    parser.add_argument("--chat-rate", type=float, default=ratelimit.CHAT_RATE,
+                        help="chat messages per second a connection may send on average, 0 for no limit")
+    parser.add_argument("--chat-burst", type=int, default=ratelimit.CHAT_BURST,
+                        help="chat messages a client may send at once, the server tolerates twice as many")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    _raiseFileLimit()
+
+    try:
+        asyncio.run(GameServer(args.chat_rate, args.chat_burst).serve(args.host, args.port, args.announce_interval))
+    except KeyboardInterrupt:
+        pass
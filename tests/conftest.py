@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the HiChess project.
+# Copyright (C) 2019-2020 Haik Sargsian <haiksargsian6@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import pytest
+
+import os
+import sys
+import types
+
+# the modules of src import each other by their bare names, as when main.py is run
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+try:
+    import resources
+except ImportError:
+    # resources.py is generated from resources.qrc with pyside2-rcc and only registers the images,
+    # the tests run without them
+    sys.modules["resources"] = types.ModuleType("resources")
+
+
+@pytest.fixture(scope="session")
+def app():
+    from PySide2 import QtWidgets
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+    # the chat dock has no window of its own to keep the application running
+    app.setQuitOnLastWindowClosed(False)
+    return app
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the HiChess project.
+# Copyright (C) 2019-2020 Haik Sargsian <haiksargsian6@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from PySide2 import QtNetwork
+
+import discovery
+
+
+def test_start(app):
+    serverDiscovery = discovery.ServerDiscovery()
+    # another client on this machine shares the port, so binding it is expected to work here
+    assert serverDiscovery.start()
+    assert serverDiscovery.udpSocket.state() == QtNetwork.QAbstractSocket.BoundState
+    assert serverDiscovery.rankedServers() == []
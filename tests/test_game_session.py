@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the HiChess project.
+# Copyright (C) 2019-2020 Haik Sargsian <haiksargsian6@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+""" Many games in a row over the same two clients, as a window plays them, against a `server.GameServer`
+running in-process. Nothing a `GameSession` set up may outlive it: each move takes the same number
+of packets and the connections, chat widgets and sockets stay as many as after the first game. """
+
+import pytest
+
+import asyncio
+import threading
+import time
+from functools import partial
+from typing import Callable, List
+
+import chess
+import chess.polyglot
+import websockets
+from PySide2 import QtCore, QtWebSockets, QtWidgets
+
+import chatwidget
+import client
+import game_session
+import server
+
+GAMES = 8
+MOVES = ["e2e4", "e7e5", "g1f3", "b8c6", "f1c4", "g8f6", "d2d3", "f8c5"]
+TIMEOUT = 5.0
+
+
+@pytest.fixture
+def gameServer():
+    gameServer = server.GameServer()
+    ready = threading.Event()
+    port: List[int] = []
+    loop = asyncio.new_event_loop()
+    stopped = loop.create_future()
+
+    async def serve():
+        async with websockets.serve(gameServer.handler, "127.0.0.1", 0, compression=None) as webSocketServer:
+            port.append(webSocketServer.sockets[0].getsockname()[1])
+            ready.set()
+            await stopped
+
+    thread = threading.Thread(target=loop.run_until_complete, args=(serve(),), daemon=True)
+    thread.start()
+    assert ready.wait(TIMEOUT)
+    gameServer.url = f"ws://127.0.0.1:{port[0]}"
+    yield gameServer
+    loop.call_soon_threadsafe(stopped.set_result, None)
+    thread.join(TIMEOUT)
+    loop.close()
+
+
+def waitFor(app: QtWidgets.QApplication, condition: Callable[[], bool]):
+    deadline = time.monotonic() + TIMEOUT
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        app.processEvents(QtCore.QEventLoop.AllEvents, 10)
+        time.sleep(0.001)
+
+
+def collectGarbage(app: QtWidgets.QApplication):
+    app.processEvents()
+    QtCore.QCoreApplication.sendPostedEvents(None, QtCore.QEvent.DeferredDelete)
+
+
+def test_consecutiveGames(app, gameServer):
+    alice = client.Client("alice_01")
+    bobby = client.Client("bobby_01")
+    chat = chatwidget.ChatWidget(layoutThread=False)
+    chat.show()
+    messageReceived = QtCore.SIGNAL("messageReceived(QString)")
+    moveReceived = QtCore.SIGNAL("moveReceived(PyObject,int,PyObject,double)")
+    baseReceivers = [player.receivers(signal) for player in (alice, bobby)
+                     for signal in (messageReceived, moveReceived)]
+
+    packetsPerMove = []
+    webSockets = []
+    for game in range(GAMES):
+        colors = {}
+        alice.gameStarted.connect(lambda packet: colors.setdefault(alice, packet.contentType))
+        alice.startConnectionWithServer(gameServer.url)
+        waitFor(app, lambda: gameServer.queue)
+        bobby.startConnectionWithServer(gameServer.url)
+        waitFor(app, lambda: alice.inGame and bobby.inGame and colors)
+        alice.gameStarted.disconnect()
+
+        white, black = (alice, bobby) if colors[alice] == client.WHITE_PLAYER_DATA else (bobby, alice)
+
+        session = game_session.GameSession(chatWidget=chat)
+        received = []
+        for player in (white, black):
+            session.connectSignal(player.moveReceived,
+                                  lambda move, ply, positionHash, receivedAt: received.append(move))
+        session.connectSignal(chat.messageToBeSent, partial(alice.sendPacket, client.MESSAGE))
+        session.connectSignal(alice.messageReceived, partial(chat.showMessage, chatwidget.OPPONENT))
+        session.connectSignal(bobby.messageReceived, partial(chat.showMessage, chatwidget.OPPONENT))
+        assert session.connectionCount() == 5
+
+        sentBefore = sum(player.sendQueue.sentFrames[client.CONTROL_LANE] for player in (white, black))
+        board = chess.Board()
+        for i, uci in enumerate(MOVES):
+            player = white if board.turn == chess.WHITE else black
+            move = chess.Move.from_uci(uci)
+            san = board.san(move)
+            board.push(move)
+            player.sendMove(move, san, chess.polyglot.zobrist_hash(board))
+            waitFor(app, lambda: len(received) == i + 1)
+        assert received == [chess.Move.from_uci(uci) for uci in MOVES]
+        sent = sum(player.sendQueue.sentFrames[client.CONTROL_LANE] for player in (white, black)) - sentBefore
+        packetsPerMove.append(sent / len(MOVES))
+
+        bobby.sendPacket(client.MESSAGE, f"good game {game}")
+        waitFor(app, lambda: chat.model.rowCount() == 1)
+        assert chat.model.message(0).text == f"good game {game}"
+
+        session.close()
+        assert session.closed
+        assert session.connectionCount() == 0
+        assert chat.model.rowCount() == 0
+        alice.close()
+        bobby.close()
+        waitFor(app, lambda: not gameServer.games and not gameServer.connections)
+        collectGarbage(app)
+
+        assert [player.receivers(signal) for player in (alice, bobby)
+                for signal in (messageReceived, moveReceived)] == baseReceivers
+        assert sum(isinstance(widget, chatwidget.ChatWidget) for widget in QtWidgets.QApplication.allWidgets()) == 1
+        webSockets.append(len(alice.findChildren(QtWebSockets.QWebSocket)) +
+                          len(bobby.findChildren(QtWebSockets.QWebSocket)))
+
+    assert packetsPerMove == [1.0] * GAMES
+    assert webSockets == [webSockets[0]] * GAMES
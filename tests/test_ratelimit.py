@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the HiChess project.
+# Copyright (C) 2019-2020 Haik Sargsian <haiksargsian6@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import ratelimit
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_paced():
+    clock = Clock()
+    bucket = ratelimit.TokenBucket(2.0, 3, clock)
+    assert all(bucket.take() for _ in range(3))
+    assert not bucket.take()
+    assert bucket.delay() == 0.5
+
+    clock.now = 0.5
+    assert bucket.delay() == 0.0
+    assert bucket.take()
+    assert not bucket.take()
+
+
+def test_unlimited():
+    # a rate of 0, as from chat/rate=0, lets everything through instead of nothing
+    for rate in (0.0, -1.0):
+        bucket = ratelimit.TokenBucket(rate, 1, Clock())
+        assert all(bucket.take() for _ in range(100))
+        assert bucket.delay() == 0.0